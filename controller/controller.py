@@ -1,3 +1,4 @@
+import os
 import pygame
 import time
 import paho.mqtt.client as mqtt
@@ -7,6 +8,15 @@ broker = "localhost"
 topic = "controller/input"
 client = mqtt.Client()
 client.connect(broker, 1883, 60)
+# Append the publish time to every message, for the motor controller's latency tracing (LATENCY_TRACE)
+trace_latency = os.environ.get("TRACE_LATENCY") == "1"
+
+
+def publish(message):
+    if trace_latency:
+        message = f"{message}:{time.time():.6f}"
+    client.publish(topic, message)
+
 
 # Initialize Pygame
 pygame.init()
@@ -97,7 +107,7 @@ try:
             if direction != 0:
                 if not active_channels[channel] or (current_time - last_sent_time[channel]) >= send_interval:
                     message = f"{channel}:1:{direction}"
-                    client.publish(topic, message)
+                    publish(message)
                     print(f"Sent: {message}")
                     last_sent_time[channel] = current_time
                     active_channels[channel] = True
@@ -122,7 +132,7 @@ try:
             if trigger_value != 0:
                 if not active_channels[2] or (current_time - last_sent_time[2]) >= send_interval:
                     message = f"2:1:{trigger_value}"
-                    client.publish(topic, message)
+                    publish(message)
                     print(f"Sent: {message}")
                     last_sent_time[2] = current_time
                     active_channels[2] = True
@@ -140,7 +150,7 @@ try:
             if direction_4 != 0:
                 if not active_channels[4] or (current_time - last_sent_time[4]) >= send_interval:
                     message = f"4:1:{direction_4}"
-                    client.publish(topic, message)
+                    publish(message)
                     print(f"Sent: {message}")
                     last_sent_time[4] = current_time
                     active_channels[4] = True
@@ -168,7 +178,7 @@ try:
             if button_value != 0:
                 if not active_channels[6] or (current_time - last_sent_time[6]) >= send_interval:
                     message = f"6:1:{button_value}"
-                    client.publish(topic, message)
+                    publish(message)
                     print(f"Sent: {message}")
                     last_sent_time[6] = current_time
                     active_channels[6] = True
@@ -182,7 +192,7 @@ try:
         # Button A for reset
         if controller.get_button(0):
             message = "0:2:0"
-            client.publish(topic, message)
+            publish(message)
             print(f"Sent: {message}")
             time.sleep(0.3)
 
@@ -81,56 +81,64 @@ func subscribe(c mqtt.Client, topic string, writeAPI api.WriteAPIBlocking) {
 
 func messageHandler(writeAPI api.WriteAPIBlocking) mqtt.MessageHandler {
 	return func(_ mqtt.Client, msg mqtt.Message) {
-		payload := string(msg.Payload())
 		topic := msg.Topic()
-		parts := strings.Split(strings.TrimSpace(payload), ":")
-		if len(parts) != 3 {
-			log.Printf("Invalid format: %s\n", payload)
-			return
-		}
-		motorID := parts[0]
-		kind, err := strconv.Atoi(parts[1])
-		if err != nil {
-			log.Printf("Invalid movement type '%s': %v\n", parts[1], err)
-			return
-		}
-		amt, err := strconv.ParseFloat(parts[2], 64)
-		if err != nil {
-			log.Printf("Invalid amount '%s': %v\n", parts[2], err)
-			return
+		// Several commands may be joined by ","
+		for _, command := range strings.Split(strings.TrimSpace(string(msg.Payload())), ",") {
+			handleCommand(writeAPI, topic, command)
 		}
+	}
+}
 
-		mu.Lock()
-		cur := motorPositions[motorID]
-		var newPos float64
-		switch kind {
-		case 0: // Absolute
-			newPos = amt
-		case 1: // Relative
-			newPos = cur + amt
-		case 2: // Reset
-			newPos = 0
-		default:
-			log.Printf("Unknown movement type '%d'\n", kind)
-			mu.Unlock()
-			return
-		}
-		motorPositions[motorID] = newPos
+// handleCommand applies one "motor_id:movement_type:amount" command. Further
+// fields (e.g. the publish timestamp added for latency tracing) are ignored.
+func handleCommand(writeAPI api.WriteAPIBlocking, topic, payload string) {
+	parts := strings.Split(strings.TrimSpace(payload), ":")
+	if len(parts) < 3 {
+		log.Printf("Invalid format: %s\n", payload)
+		return
+	}
+	motorID := parts[0]
+	kind, err := strconv.Atoi(parts[1])
+	if err != nil {
+		log.Printf("Invalid movement type '%s': %v\n", parts[1], err)
+		return
+	}
+	amt, err := strconv.ParseFloat(parts[2], 64)
+	if err != nil {
+		log.Printf("Invalid amount '%s': %v\n", parts[2], err)
+		return
+	}
+
+	mu.Lock()
+	cur := motorPositions[motorID]
+	var newPos float64
+	switch kind {
+	case 0: // Absolute
+		newPos = amt
+	case 1: // Relative
+		newPos = cur + amt
+	case 2: // Reset
+		newPos = 0
+	default:
+		log.Printf("Unknown movement type '%d'\n", kind)
 		mu.Unlock()
+		return
+	}
+	motorPositions[motorID] = newPos
+	mu.Unlock()
 
-		p := influxdb2.NewPoint(
-			"motor_positions",
-			map[string]string{
-				"motor_id": motorID,
-				"topic":    topic,
-			},
-			map[string]interface{}{"position": newPos},
-			time.Now(),
-		)
-		if err := writeAPI.WritePoint(context.Background(), p); err != nil {
-			log.Printf("InfluxDB write error: %v\n", err)
-		} else {
-			log.Printf("Wrote motor '%s' pos=%.2f\n", motorID, newPos)
-		}
+	p := influxdb2.NewPoint(
+		"motor_positions",
+		map[string]string{
+			"motor_id": motorID,
+			"topic":    topic,
+		},
+		map[string]interface{}{"position": newPos},
+		time.Now(),
+	)
+	if err := writeAPI.WritePoint(context.Background(), p); err != nil {
+		log.Printf("InfluxDB write error: %v\n", err)
+	} else {
+		log.Printf("Wrote motor '%s' pos=%.2f\n", motorID, newPos)
 	}
 }
@@ -0,0 +1,65 @@
+# Command latency on the simulated hardware: feeds joystick-like messages through the same
+# path as MainMotorControllerMQTT.on_message (parse, trace, MotionScheduler) and prints the
+# per-stage latency histograms of LatencyTracer. The broker is not involved, so
+# publish_to_receive only covers the parse.
+#
+#   python3 BenchmarkLatency.py
+#   python3 BenchmarkLatency.py --duration 20 --rate 10 --channels 0,1,2,3,6
+import argparse
+import json
+import time
+
+from Hardware import SimulatedHardware
+from LatencyTracer import LatencyTracer
+from MotionScheduler import MotionScheduler, parse_commands
+from ServoController import ServoController
+from StepperController import StepperController
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage command latency on the simulated hardware.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of input")
+    parser.add_argument("--rate", type=float, default=10, help="Messages per second and channel (controller.py: 10)")
+    parser.add_argument("--channels", default="0,1,2,3", help="Channels to send relative moves to")
+    parser.add_argument("--step", type=int, default=15, help="Relative move per message")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON (as published on the stats topic)")
+    args = parser.parse_args()
+
+    hardware = SimulatedHardware()
+    servo_controller = ServoController(hardware)
+    stepper_controller = StepperController(hardware)
+    scheduler = MotionScheduler(servo_controller, stepper_controller)
+    tracer = LatencyTracer()
+    channels = [int(channel) for channel in args.channels.split(",")]
+
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < args.duration:
+        # Sweep back and forth so the joints do not just sit at their limits
+        if int((time.monotonic() - start) / 2) % 2:
+            direction = -1
+        else:
+            direction = 1
+        for channel in channels:
+            commands, published_at = parse_commands(f"{channel}:1:{direction * args.step}:{time.time():.6f}")
+            trace = tracer.begin(published_at)
+            trace.add_part()
+            scheduler.submit(commands, trace)
+            trace.part_done()
+            sent += 1
+        next_send = start + sent / len(channels) / args.rate
+        time.sleep(max(0.0, next_send - time.monotonic()))
+
+    time.sleep(1)  # Let the last moves finish
+    servo_controller.exit()
+    stepper_controller.exit()
+
+    print(f"{sent} messages, {tracer.traces} traced to the output")
+    if args.json:
+        print(json.dumps({"traces": tracer.traces, "stages": tracer.summary(), "servo_loop": servo_controller.loop_stats()}, indent=2))
+    else:
+        tracer.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# Compares the I2C traffic of the PCA9685 output paths for a multi-joint move, on the simulated bus:
+# one set_pwm() per channel (four single-register writes each, like Adafruit_PCA9685) against
+# PwmOutput (changed channels only, contiguous channels in one block write). Bus time includes
+# the kernel overhead per transaction, see Hardware.SimulatedI2CDevice.
+#
+#   python3 BenchmarkPwmOutput.py
+#   python3 BenchmarkPwmOutput.py --profile trapezoid --bus-speed 400000
+import argparse
+
+from Hardware import SimulatedI2CDevice
+from MotionProfile import plan_trajectory
+from PwmOutput import AUTO_INCREMENT, LED0_ON_L, MODE1, REGISTERS_PER_CHANNEL, PwmOutput
+
+LINKED_CHANNEL_SUM = 650
+
+# channel: (start pulse, target pulse, max velocity, max acceleration); as in ServoController
+MOVES = {
+    0: (100, 380, 400, 2500),
+    1: (320, 500, 300, 1500),
+    2: (100, 470, 250, 1000),
+    3: (100, 400, 300, 1200),
+    4: (350, 250, 200, 800),
+}
+
+
+def trajectories(profile, tick_time):
+    plans = {channel: plan_trajectory(start, target, velocity, acceleration, profile, dt=tick_time)
+             for channel, (start, target, velocity, acceleration) in MOVES.items()}
+    longest = max(samples[-1, 0] for samples in plans.values())
+    return {channel: plan_trajectory(start, target, velocity, acceleration, profile, dt=tick_time, duration=longest)
+            for channel, (start, target, velocity, acceleration) in MOVES.items()}
+
+
+def tick_pulses(plans):
+    """Yields the dict of channel -> pulse of every tick, channel 5 mirroring channel 4."""
+    ticks = max(len(samples) for samples in plans.values())
+    for tick in range(ticks):
+        pulses = {channel: round(samples[min(tick, len(samples) - 1), 1]) for channel, samples in plans.items()}
+        pulses[5] = LINKED_CHANNEL_SUM - pulses[4]
+        yield pulses
+
+
+def run_per_channel(plans, bus_speed):
+    device = SimulatedI2CDevice(bus_speed=bus_speed, model_timing=False)
+    device.write8(MODE1, AUTO_INCREMENT)
+    device.transactions = device.bytes = 0
+    ticks = 0
+    for pulses in tick_pulses(plans):
+        for channel, pulse in pulses.items():
+            # Adafruit_PCA9685.set_pwm(): ON_L, ON_H, OFF_L, OFF_H
+            base = LED0_ON_L + REGISTERS_PER_CHANNEL * channel
+            for offset, value in enumerate((0, 0, pulse & 0xFF, pulse >> 8)):
+                device.write8(base + offset, value)
+        ticks += 1
+    return device, ticks
+
+
+def run_batched(plans, bus_speed):
+    device = SimulatedI2CDevice(bus_speed=bus_speed, model_timing=False)
+    output = PwmOutput(device)
+    output.enable_auto_increment()
+    device.transactions = device.bytes = 0
+    ticks = 0
+    for pulses in tick_pulses(plans):
+        for channel, pulse in pulses.items():
+            output.set(channel, pulse)
+        output.flush()
+        ticks += 1
+    return device, ticks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="I2C transactions per tick of the PCA9685 output paths.")
+    parser.add_argument("--profile", default="s-curve", choices=("trapezoid", "s-curve"))
+    parser.add_argument("--tick-time", type=float, default=0.02)
+    parser.add_argument("--bus-speed", type=int, default=100000, help="I2C clock in Hz")
+    args = parser.parse_args()
+
+    plans = trajectories(args.profile, args.tick_time)
+    final = {channel: pulse for pulses in tick_pulses(plans) for channel, pulse in pulses.items()}
+    print(f"{len(MOVES) + 1} channels, {args.profile} profile, tick {args.tick_time * 1000:.0f} ms, "
+          f"I2C at {args.bus_speed // 1000} kHz")
+    for name, run in (("per-channel set_pwm", run_per_channel), ("batched PwmOutput", run_batched)):
+        device, ticks = run(plans, args.bus_speed)
+        assert all(device.pulse(channel) == pulse for channel, pulse in final.items()), name
+        bus_ms = device.bus_time() * 1000
+        print(f"{name:20} {ticks} ticks  {device.transactions / ticks:6.2f} transactions/tick  "
+              f"{device.bytes / ticks:6.1f} bytes/tick  {bus_ms / ticks:5.2f} ms bus time/tick")
+
+
+if __name__ == "__main__":
+    main()
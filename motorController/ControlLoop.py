@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+
+from MovementQueue import LatencyStats
+
+# Rate of the servo control loop in Hz (servos take a new pulse every 20 ms at 50 Hz)
+MOTION_TICK_RATE_ENV = float(os.environ.get("MOTION_TICK_RATE", "50"))
+# SCHED_FIFO priority (1-99) for the motion threads; unset or 0 keeps the normal scheduler
+MOTION_RT_PRIORITY_ENV = int(os.environ.get("MOTION_RT_PRIORITY", "0"))
+# CPUs the motion threads are pinned to, e.g. "3" or "2,3"; unset for all
+MOTION_CPUS_ENV = os.environ.get("MOTION_CPUS", "")
+
+
+class TickTimer:
+    """
+    Paces a loop on absolute deadlines: tick n is due at start + n * period, so time spent
+    in the loop body does not add up to drift. A tick that overruns its whole period skips
+    the missed deadlines instead of running them back to back.
+
+    Records the wake-up jitter (how late a tick started), the work time of the loop body
+    and the number of overruns.
+    """
+
+    def __init__(self, period):
+        """
+        :param period: Tick period in seconds.
+        """
+        self.period = period
+        self.__lock = threading.Lock()
+        self.__next_tick = time.monotonic()
+        self.__tick_started = None
+        self.__reset_stats()
+
+    def __reset_stats(self):
+        self.jitter = LatencyStats()
+        self.work = LatencyStats()
+        self.overruns = 0
+        self.skipped_ticks = 0
+
+    def start(self):
+        """
+        Starts a new series of ticks now, e.g. after the loop was idle.
+        """
+        self.__next_tick = time.monotonic()
+        self.__tick_started = self.__next_tick
+
+    def wait(self):
+        """
+        Ends the current tick and sleeps until the next deadline.
+        """
+        now = time.monotonic()
+        if self.__tick_started is not None:
+            self.work.add(now - self.__tick_started)
+        self.__next_tick += self.period
+        if now > self.__next_tick:
+            # Overran: realign to the next deadline still ahead
+            missed = int((now - self.__next_tick) / self.period) + 1
+            with self.__lock:
+                self.overruns += 1
+                self.skipped_ticks += missed
+            self.__next_tick += missed * self.period
+        delay = self.__next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.__tick_started = time.monotonic()
+        self.jitter.add(max(0.0, self.__tick_started - self.__next_tick))
+
+    def stats(self):
+        """
+        :return: A dict with the tick statistics; times in milliseconds.
+        """
+        with self.__lock:
+            return {
+                "period_ms": self.period * 1000,
+                "ticks": self.jitter.count,
+                "overruns": self.overruns,
+                "skipped_ticks": self.skipped_ticks,
+                "jitter_mean_ms": self.jitter.mean * 1000,
+                "jitter_max_ms": self.jitter.max * 1000,
+                "work_mean_ms": self.work.mean * 1000,
+                "work_max_ms": self.work.max * 1000,
+            }
+
+    def reset_stats(self):
+        with self.__lock:
+            self.__reset_stats()
+
+    def summary(self):
+        """
+        :return: A short human readable summary.
+        """
+        stats = self.stats()
+        return (f"{stats['ticks']} ticks of {stats['period_ms']:.1f}ms, jitter mean={stats['jitter_mean_ms']:.2f}ms "
+                f"max={stats['jitter_max_ms']:.2f}ms, work max={stats['work_max_ms']:.2f}ms, "
+                f"{stats['overruns']} overruns ({stats['skipped_ticks']} ticks skipped)")
+
+
+def configure_realtime(name, priority=MOTION_RT_PRIORITY_ENV, cpus=MOTION_CPUS_ENV):
+    """
+    Gives the calling thread real-time priority and pins it to CPUs, as configured by
+    MOTION_RT_PRIORITY and MOTION_CPUS. Both need Linux; SCHED_FIFO also needs root or
+    CAP_SYS_NICE. Failures are reported and the thread keeps running normally.
+
+    :param name: Thread name for the log.
+    :param priority: SCHED_FIFO priority, 0 to keep the normal scheduler.
+    :param cpus: Comma separated CPU numbers, empty for all.
+    """
+    if cpus:
+        try:
+            os.sched_setaffinity(0, {int(cpu) for cpu in cpus.split(",")})
+            print(f"{name}: pinned to CPUs {cpus}")
+        except (AttributeError, OSError, ValueError) as e:
+            print(f"{name}: cannot set CPU affinity {cpus!r}: {e}")
+    if priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            print(f"{name}: SCHED_FIFO priority {priority}")
+        except (AttributeError, OSError) as e:
+            print(f"{name}: cannot set real-time priority {priority}: {e}")
@@ -0,0 +1,341 @@
+import csv
+import os
+import threading
+import time
+
+import numpy as np
+
+from PwmOutput import LED0_ON_L, MODE1, AUTO_INCREMENT, REGISTERS_PER_CHANNEL, CHANNEL_COUNT
+
+# Hardware backend: "pi" drives the PCA9685 and the stepper driver, "sim" simulates them
+MOTOR_HARDWARE_ENV = os.environ.get("MOTOR_HARDWARE", "pi")
+# If set, the simulated backend writes its output trace to this CSV file on close()
+MOTOR_TRACE_ENV = os.environ.get("MOTOR_TRACE")
+
+PCA9685_ADDRESS = 0x40
+I2C_BUS = 1
+PWM_FREQUENCY = 50
+
+I2C_BUS_SPEED = 100000  # Hz, the Raspberry Pi default
+I2C_TRANSACTION_OVERHEAD = 0.0001  # Seconds per transaction spent in the kernel driver (ioctl)
+STEP_PULSE_US = 10  # High time of hardware-timed step pulses (A4988: at least 1 us)
+
+
+class PiHardware:
+    """
+    The robot's hardware: PCA9685 servo driver on I2C and an A4988 stepper driver on GPIO.
+    The hardware libraries are only imported here, so the rest of the package loads anywhere.
+    """
+
+    def pwm_device(self):
+        """
+        Sets up the PCA9685 for servo pulses.
+
+        :return: Its I2C device, see PwmOutput.
+        """
+        import Adafruit_PCA9685
+
+        pwm = Adafruit_PCA9685.PCA9685(address=PCA9685_ADDRESS, busnum=I2C_BUS)
+        pwm.set_pwm_freq(PWM_FREQUENCY)
+        return pwm._device
+
+    def stepper_driver(self, direction_pin, step_pin, enable_pin):
+        """
+        :return: A GpioStepperDriver for the given pins (BCM numbering).
+        """
+        return GpioStepperDriver(direction_pin, step_pin, enable_pin)
+
+    def step_waveform(self, driver, step_pin):
+        """
+        :return: A PigpioWaveform on the step pin (needs the pigpiod daemon).
+        """
+        return PigpioWaveform(step_pin)
+
+    def close(self):
+        pass
+
+
+class GpioStepperDriver:
+    """
+    Step/direction/enable interface of an A4988 stepper driver on Raspberry Pi GPIO pins.
+    """
+
+    def __init__(self, direction_pin, step_pin, enable_pin):
+        import RPi.GPIO as GPIO
+
+        self.__gpio = GPIO
+        self.__direction_pin = direction_pin
+        self.__step_pin = step_pin
+        self.__enable_pin = enable_pin
+        GPIO.setmode(GPIO.BCM)
+        for pin in (direction_pin, step_pin, enable_pin):
+            GPIO.setup(pin, GPIO.OUT)
+        self.set_enabled(False)
+
+    def set_enabled(self, enabled):
+        """
+        :param enabled: Whether the motor is powered (the enable input is active low).
+        """
+        self.__gpio.output(self.__enable_pin, self.__gpio.LOW if enabled else self.__gpio.HIGH)
+
+    def set_direction(self, clockwise):
+        self.__gpio.output(self.__direction_pin, clockwise)
+
+    def step(self):
+        """
+        Sends one step pulse. A GPIO write takes a few microseconds, longer than the minimum
+        pulse width, so no extra wait is needed.
+        """
+        self.__gpio.output(self.__step_pin, self.__gpio.HIGH)
+        self.__gpio.output(self.__step_pin, self.__gpio.LOW)
+
+
+class PigpioWaveform:
+    """
+    Hardware-timed step pulses on the Pi: a move's delay table becomes a pigpio waveform,
+    which the pigpio daemon plays by DMA with microsecond accuracy.
+    """
+
+    def __init__(self, step_pin):
+        import pigpio
+
+        self.__pigpio = pigpio
+        self.__pi = pigpio.pi()
+        if not self.__pi.connected:
+            raise RuntimeError("Cannot connect to pigpiod, is the daemon running?")
+        self.__step_mask = 1 << step_pin
+        self.__pi.set_mode(step_pin, pigpio.OUTPUT)
+        self.__times = np.empty(0)
+        self.__start = 0.0
+
+    def play(self, delays_us):
+        """
+        Starts sending step pulses in the background.
+
+        :param delays_us: The delay before each step in microseconds.
+        """
+        pulse = self.__pigpio.pulse
+        pulses = []
+        wait = 0
+        for delay in delays_us:
+            pulses.append(pulse(0, 0, int(delay) - wait))
+            pulses.append(pulse(self.__step_mask, 0, STEP_PULSE_US))
+            pulses.append(pulse(0, self.__step_mask, 0))
+            wait = STEP_PULSE_US
+        self.__pi.wave_clear()
+        self.__pi.wave_add_generic(pulses)
+        wave = self.__pi.wave_create()
+        self.__times = np.cumsum(delays_us) / 1e6
+        self.__start = time.monotonic()
+        self.__pi.wave_send_once(wave)
+
+    def busy(self):
+        return bool(self.__pi.wave_tx_busy())
+
+    def stop(self):
+        """
+        Stops the waveform if it is still playing.
+
+        :return: The number of steps sent (estimated from the elapsed time if stopped early).
+        """
+        if self.busy():
+            self.__pi.wave_tx_stop()
+            return int(np.searchsorted(self.__times, time.monotonic() - self.__start, side="right"))
+        return len(self.__times)
+
+
+class OutputTrace:
+    """
+    Thread-safe, timestamped record of every output change of the simulated hardware.
+    Events are (time.monotonic(), kind, channel, value) with kind "pwm", "enable", "direction"
+    or "step".
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__events = []
+
+    def record(self, kind, channel, value, timestamp=None):
+        with self.__lock:
+            self.__events.append((timestamp or time.monotonic(), kind, channel, value))
+
+    def events(self, kind=None):
+        """
+        :param kind: Only return events of this kind, None for all.
+        :return: A list of the recorded events, oldest first.
+        """
+        with self.__lock:
+            return [event for event in self.__events if kind is None or event[1] == kind]
+
+    def write_csv(self, path):
+        """
+        Writes the trace to a CSV file, with times relative to the first event.
+
+        :param path: The file to write.
+        """
+        events = self.events()
+        start = events[0][0] if events else 0.0
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["time", "kind", "channel", "value"])
+            for timestamp, kind, channel, value in events:
+                writer.writerow([f"{timestamp - start:.6f}", kind, channel, value])
+
+
+class SimulatedI2CDevice:
+    """
+    A PCA9685 behind a simulated I2C bus, with the interface of an Adafruit_GPIO.I2C.Device.
+    Counts transactions and bus bytes, records every changed channel pulse in the trace and,
+    if model_timing is set, takes as long as the transfer would on the real bus.
+    """
+
+    def __init__(self, trace=None, bus_speed=I2C_BUS_SPEED, model_timing=True):
+        self.__trace = trace
+        self.__bus_speed = bus_speed
+        self.__model_timing = model_timing
+        self.registers = [0] * 256
+        self.transactions = 0
+        self.bytes = 0  # Including address and register byte of every transaction
+
+    def readU8(self, register):
+        self.__transfer(3)  # Address + register, repeated start, address + data
+        return self.registers[register]
+
+    def write8(self, register, value):
+        self.writeList(register, [value])
+
+    def writeList(self, register, data):
+        if len(data) > 1 and not self.registers[MODE1] & AUTO_INCREMENT:
+            raise RuntimeError("Block write without auto-increment enabled")
+        self.__transfer(2 + len(data))
+        before = [self.pulse(channel) for channel in range(CHANNEL_COUNT)]
+        for offset, value in enumerate(data):
+            self.registers[register + offset] = value
+        if self.__trace is not None:
+            for channel in range(CHANNEL_COUNT):
+                if self.pulse(channel) != before[channel]:
+                    self.__trace.record("pwm", channel, self.pulse(channel))
+
+    def pulse(self, channel):
+        """
+        :return: The off time currently set for a channel.
+        """
+        base = LED0_ON_L + REGISTERS_PER_CHANNEL * channel
+        return self.registers[base + 2] | self.registers[base + 3] << 8
+
+    def bus_time(self):
+        """
+        :return: The seconds the transactions so far would have taken on the real bus.
+        """
+        # 9 clocks per byte plus start and stop condition per transaction
+        return (self.bytes * 9 + self.transactions * 2) / self.__bus_speed + self.transactions * I2C_TRANSACTION_OVERHEAD
+
+    def __transfer(self, size):
+        self.transactions += 1
+        self.bytes += size
+        if self.__model_timing:
+            time.sleep((size * 9 + 2) / self.__bus_speed + I2C_TRANSACTION_OVERHEAD)
+
+
+class SimulatedStepperDriver:
+    """
+    Stepper driver that records its inputs in the trace instead of driving pins.
+    Keeps the position in steps so tests can check where the motor ended up.
+    """
+
+    def __init__(self, trace):
+        self.__trace = trace
+        self.__clockwise = True
+        self.enabled = False
+        self.position = 0
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        self.__trace.record("enable", None, int(enabled))
+
+    def set_direction(self, clockwise):
+        self.__clockwise = clockwise
+        self.__trace.record("direction", None, int(clockwise))
+
+    def step(self, timestamp=None):
+        """
+        :param timestamp: When the step happened, None for now.
+        """
+        self.position += 1 if self.__clockwise else -1
+        self.__trace.record("step", None, self.position, timestamp)
+
+
+class SimulatedWaveform:
+    """
+    Hardware-timed step pulses, simulated: every step is recorded at exactly its planned time.
+    Plays for as long as the real waveform would.
+    """
+
+    def __init__(self, driver):
+        self.__driver = driver
+        self.__times = np.empty(0)
+        self.__start = 0.0
+        self.__recorded = 0
+
+    def play(self, delays_us):
+        self.__times = np.cumsum(delays_us) / 1e6
+        self.__start = time.monotonic()
+        self.__recorded = 0
+
+    def busy(self):
+        return self.__recorded < len(self.__times) and time.monotonic() < self.__start + self.__times[-1]
+
+    def stop(self):
+        """
+        :return: The number of steps sent, see PigpioWaveform.stop().
+        """
+        sent = int(np.searchsorted(self.__times, time.monotonic() - self.__start, side="right"))
+        for step_time in self.__times[self.__recorded:sent]:
+            self.__driver.step(self.__start + step_time)
+        self.__recorded = len(self.__times)
+        return sent
+
+
+class SimulatedHardware:
+    """
+    Simulated PCA9685 and stepper driver for running, profiling and load testing the
+    controllers without the robot. All outputs go to one OutputTrace.
+    """
+
+    def __init__(self, trace_path=None, model_timing=True):
+        self.trace = OutputTrace()
+        self.__trace_path = trace_path
+        self.__model_timing = model_timing
+        self.pwm = None
+        self.stepper = None
+
+    def pwm_device(self):
+        self.pwm = SimulatedI2CDevice(self.trace, model_timing=self.__model_timing)
+        return self.pwm
+
+    def stepper_driver(self, direction_pin, step_pin, enable_pin):
+        self.stepper = SimulatedStepperDriver(self.trace)
+        return self.stepper
+
+    def step_waveform(self, driver, step_pin):
+        return SimulatedWaveform(driver)
+
+    def close(self):
+        if self.__trace_path:
+            self.trace.write_csv(self.__trace_path)
+            print(f"Output trace written to {self.__trace_path}")
+
+
+def create_hardware(name=MOTOR_HARDWARE_ENV):
+    """
+    Creates the hardware backend selected by MOTOR_HARDWARE.
+
+    :param name: "pi" or "sim".
+    :return: A PiHardware or SimulatedHardware.
+    """
+    if name == "pi":
+        return PiHardware()
+    if name == "sim":
+        print("Using simulated motor hardware")
+        return SimulatedHardware(MOTOR_TRACE_ENV)
+    raise ValueError(f"Unknown MOTOR_HARDWARE '{name}', expected 'pi' or 'sim'")
@@ -0,0 +1,218 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Tracing is off unless LATENCY_TRACE=1
+LATENCY_TRACE_ENV = os.environ.get("LATENCY_TRACE", "0") == "1"
+LATENCY_STATS_TOPIC_ENV = os.environ.get("LATENCY_STATS_TOPIC", "motor/stats")
+LATENCY_STATS_INTERVAL_ENV = float(os.environ.get("LATENCY_STATS_INTERVAL", "10"))
+
+# Upper bounds of the histogram buckets in milliseconds; the last bucket is open
+BUCKET_BOUNDS_MS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# Stages between the timestamps of a command: publish (controller.py), receive (on_message),
+# enqueue (controller queue), start (motion worker), output (first output write), complete
+STAGES = (
+    ("publish_to_receive", "publish", "receive"),
+    ("receive_to_enqueue", "receive", "enqueue"),
+    ("enqueue_to_start", "enqueue", "start"),
+    ("start_to_output", "start", "output"),
+    ("output_to_complete", "output", "complete"),
+    ("receive_to_output", "receive", "output"),
+    ("publish_to_output", "publish", "output"),
+)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets (BUCKET_BOUNDS_MS). Percentiles are reported as the
+    upper bound of the bucket they fall in.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        with self.__lock:
+            self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, milliseconds)] += 1
+            self.count += 1
+            self.total += milliseconds
+            self.max = max(self.max, milliseconds)
+
+    def percentile(self, fraction):
+        """
+        :param fraction: e.g. 0.95 for the 95th percentile.
+        :return: The upper bound of the bucket in milliseconds (the maximum for the open bucket).
+        """
+        with self.__lock:
+            rank = fraction * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    return BUCKET_BOUNDS_MS[index] if index < len(BUCKET_BOUNDS_MS) else self.max
+            return 0.0
+
+    def summary(self):
+        """
+        :return: A dict with count, mean, max and percentiles in milliseconds, and the bucket counts.
+        """
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": round(self.max, 3),
+            "buckets": dict(zip([str(bound) for bound in BUCKET_BOUNDS_MS] + ["inf"], self.counts)),
+        }
+
+
+class CommandTrace:
+    """
+    Timestamps of one MQTT message on its way to the outputs. The controllers that queue a part
+    of it call add_part() and part_done(); once every part is done the trace is recorded.
+    Times are time.monotonic(), except the publish time, which comes from another process
+    (see LatencyTracer.begin()). Whoever hands the message to the controllers holds a part
+    until all of it is queued, so the trace cannot complete half way.
+    """
+
+    def __init__(self, tracer, published_at=None):
+        self.__tracer = tracer
+        self.__lock = threading.Lock()
+        self.__parts = 0
+        self.stamps = {"receive": time.monotonic()}
+        if published_at is not None:
+            # Wall clock to monotonic; only meaningful if both clocks are synchronized
+            self.stamps["publish"] = self.stamps["receive"] - (time.time() - published_at)
+
+    def mark(self, stage, at=None):
+        """
+        Records the time a stage was reached; only the first time counts.
+
+        :param stage: "enqueue", "start" or "output".
+        :param at: When it was reached (time.monotonic()), None for now.
+        """
+        with self.__lock:
+            self.stamps.setdefault(stage, time.monotonic() if at is None else at)
+
+    def add_part(self, parts=1):
+        with self.__lock:
+            self.__parts += parts
+
+    def part_done(self):
+        """
+        Marks one part as finished (or replaced by a newer command). The last one completes the trace.
+        """
+        with self.__lock:
+            self.__parts -= 1
+            if self.__parts > 0:
+                return
+            self.stamps.setdefault("complete", time.monotonic())
+        self.__tracer.record(self)
+
+
+class NullTrace:
+    """
+    Stands in for a CommandTrace when tracing is off, so callers need no checks.
+    """
+
+    def mark(self, stage, at=None):
+        pass
+
+    def add_part(self, parts=1):
+        pass
+
+    def part_done(self):
+        pass
+
+
+NO_TRACE = NullTrace()
+
+
+class LatencyTracer:
+    """
+    Collects CommandTraces into one latency histogram per stage and can publish a summary
+    periodically on an MQTT topic.
+    """
+
+    def __init__(self):
+        self.histograms = {name: Histogram() for name, _, _ in STAGES}
+        self.traces = 0
+        self.__publisher = None
+        self.__stop = threading.Event()
+
+    def begin(self, published_at=None):
+        """
+        Starts the trace of a received message.
+
+        :param published_at: The publish time (time.time()) sent along by the publisher, if any.
+        :return: A CommandTrace.
+        """
+        return CommandTrace(self, published_at)
+
+    def record(self, trace):
+        if "enqueue" not in trace.stamps:
+            return  # Nothing was queued, e.g. an invalid command
+        self.traces += 1
+        for name, start, end in STAGES:
+            if start in trace.stamps and end in trace.stamps:
+                self.histograms[name].add(max(0.0, trace.stamps[end] - trace.stamps[start]))
+
+    def summary(self):
+        """
+        :return: A dict of stage -> Histogram.summary() for every stage with samples.
+        """
+        return {name: histogram.summary() for name, histogram in self.histograms.items() if histogram.count}
+
+    def start_publishing(self, client, topic=LATENCY_STATS_TOPIC_ENV, interval=LATENCY_STATS_INTERVAL_ENV, extra=None):
+        """
+        Publishes the summary as JSON every interval seconds.
+
+        :param client: A connected paho MQTT client.
+        :param topic: The topic to publish on.
+        :param interval: Seconds between two summaries.
+        :param extra: Optional callable returning a dict merged into every summary.
+        """
+        def publish():
+            while not self.__stop.wait(interval):
+                stats = {"traces": self.traces, "stages": self.summary()}
+                if extra is not None:
+                    stats.update(extra())
+                client.publish(topic, json.dumps(stats))
+
+        self.__publisher = threading.Thread(target=publish, daemon=True)
+        self.__publisher.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def print_summary(self):
+        for name, stats in self.summary().items():
+            print(f"{name}: n={stats['count']} mean={stats['mean_ms']:.2f}ms p95<={stats['p95_ms']}ms max={stats['max_ms']:.2f}ms")
+
+
+def create_tracer():
+    """
+    :return: A LatencyTracer if LATENCY_TRACE is set, otherwise None.
+    """
+    if LATENCY_TRACE_ENV:
+        print("Latency tracing enabled")
+        return LatencyTracer()
+    return None
+
+
+def begin_trace(tracer, published_at=None):
+    """
+    :param tracer: A LatencyTracer, or None if tracing is off.
+    :param published_at: The publish time sent along with the message, if any.
+    :return: A new CommandTrace, or NO_TRACE if tracing is off.
+    """
+    return tracer.begin(published_at) if tracer is not None else NO_TRACE
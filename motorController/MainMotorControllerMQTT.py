@@ -1,15 +1,22 @@
+import sys
+
 import paho.mqtt.client as mqtt
 
+from Hardware import create_hardware
+from LatencyTracer import begin_trace, create_tracer
+from MotionScheduler import MotionScheduler, parse_commands
 from ServoController import ServoController
 from StepperController import StepperController
 
 SUBSCRIBE_TOPIC_WEB = "web/input"
 SUBSCRIBE_TOPIC_CONTROLLER = "controller/input"
-STEPPER_CHANNEL = 6
 
-servo_controller = ServoController()
-stepper_controller = StepperController()
-servo_controller.move_default_servo_position()
+hardware = create_hardware()  # MOTOR_HARDWARE=sim runs without the robot
+servo_controller = ServoController(hardware)
+stepper_controller = StepperController(hardware)
+motion_scheduler = MotionScheduler(servo_controller, stepper_controller)
+motion_scheduler.move_home()
+tracer = create_tracer()  # LATENCY_TRACE=1 traces every command from publish to output
 
 def on_message(client, userdata, msg):
     print(f"Received `{msg.payload.decode()}` from `{msg.topic}`")
@@ -24,22 +31,26 @@ def on_message(client, userdata, msg):
         print("Exit Programm.")
         servo_controller.exit()
         stepper_controller.exit()
+        hardware.close()
+        if tracer is not None:
+            tracer.print_summary()
         sys.exit()
+    if input_str == "cancel":
+        # Stops the arm where it is and drops every queued move
+        motion_scheduler.cancel()
+        return
+    if input_str == "stats":
+        print(f"Servo control loop: {servo_controller.loop_stats()}")
+        if tracer is not None:
+            tracer.print_summary()
+        return
     try:
-        parsed = input_str.split(":")
-        channel = int(parsed[0])
-        move = int(parsed[1])
-        target_pulse = int(parsed[2])
-
-        if channel == STEPPER_CHANNEL:
-            stepper_controller.add_queue_command(move,target_pulse)
-        else:
-            if move == 0:
-                servo_controller.move_servo_to_position(channel, int(target_pulse))
-            if move == 1:
-                servo_controller.move_servo_direction(channel, int(target_pulse))
-            if move == 2:
-                servo_controller.move_default_servo_position()
+        # "channel:move:pulse", several joined by "," are moved together
+        commands, published_at = parse_commands(input_str)
+        trace = begin_trace(tracer, published_at)
+        trace.add_part()  # Held until every command is queued
+        motion_scheduler.submit(commands, trace)
+        trace.part_done()
     except Exception as e:
         print(f"Fehler: {e}")
 
@@ -48,10 +59,15 @@ client.connect("localhost", 1883, 60)
 client.subscribe(SUBSCRIBE_TOPIC_WEB)
 client.subscribe(SUBSCRIBE_TOPIC_CONTROLLER)
 client.on_message = on_message
+if tracer is not None:
+    tracer.start_publishing(client, extra=lambda: {"servo_loop": servo_controller.loop_stats()})
 
 try:
     client.loop_forever()
 except KeyboardInterrupt:
     client.disconnect()
     servo_controller.exit()
-    stepper_controller.exit()
\ No newline at end of file
+    stepper_controller.exit()
+    hardware.close()
+    if tracer is not None:
+        tracer.print_summary()
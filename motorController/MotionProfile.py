@@ -0,0 +1,160 @@
+import numpy as np
+
+PROFILES = ("trapezoid", "s-curve")
+
+# Fine time resolution the velocity profile is integrated at, as a fraction of the sample interval
+OVERSAMPLING = 8
+
+
+def _trapezoid_knots(distance, max_velocity, max_acceleration, initial_velocity=0.0):
+    """
+    Builds the knots of a trapezoidal velocity profile: accelerate, cruise at max_velocity if
+    the distance allows it, decelerate to a stop at the target. If the initial velocity points
+    away from the target, or is too high to stop in time, the axis first brakes to a stop. If it
+    is just above max_velocity, the axis first slows down to max_velocity.
+
+    :param distance: Signed distance to travel.
+    :param max_velocity: Maximum velocity (units per second).
+    :param max_acceleration: Maximum acceleration (units per second squared).
+    :param initial_velocity: Signed velocity at the start.
+    :return: (times, velocities) of the knots; the velocity is linear between them.
+    """
+    times = [0.0]
+    velocities = [float(initial_velocity)]
+    t = 0.0
+    velocity = float(initial_velocity)
+
+    stopping_distance = velocity * abs(velocity) / (2 * max_acceleration)
+    if velocity != 0 and (np.sign(velocity) != np.sign(distance) or abs(stopping_distance) > abs(distance)):
+        t += abs(velocity) / max_acceleration
+        distance -= stopping_distance
+        velocity = 0.0
+        times.append(t)
+        velocities.append(0.0)
+    elif abs(velocity) > max_velocity:
+        slow_time = (abs(velocity) - max_velocity) / max_acceleration
+        capped = float(np.sign(velocity)) * max_velocity
+        t += slow_time
+        distance -= (velocity + capped) / 2 * slow_time
+        velocity = capped
+        times.append(t)
+        velocities.append(velocity)
+
+    direction = 1.0 if distance >= 0 else -1.0
+    remaining = abs(distance)
+    start_speed = abs(velocity)
+    peak = min(max_velocity, np.sqrt((2 * max_acceleration * remaining + start_speed ** 2) / 2))
+    peak = max(peak, start_speed)
+    accel_time = (peak - start_speed) / max_acceleration
+    accel_distance = (peak ** 2 - start_speed ** 2) / (2 * max_acceleration)
+    decel_time = peak / max_acceleration
+    decel_distance = peak ** 2 / (2 * max_acceleration)
+    cruise_time = max(0.0, (remaining - accel_distance - decel_distance) / peak) if peak > 0 else 0.0
+
+    for duration, speed in ((accel_time, peak), (cruise_time, peak), (decel_time, 0.0)):
+        t += duration
+        times.append(t)
+        velocities.append(direction * speed)
+    return np.array(times), np.array(velocities)
+
+
+def plan_trajectory(start, target, max_velocity, max_acceleration, profile="trapezoid", jerk_time=0.1,
+                    initial_velocity=0.0, dt=0.02, duration=None, position_limits=None):
+    """
+    Precomputes the trajectory of one axis from start to target.
+
+    The trapezoid profile limits velocity and acceleration. The s-curve profile additionally
+    limits jerk: its velocity is the trapezoid's, smoothed with a moving average of jerk_time
+    seconds, so acceleration ramps up and down over jerk_time instead of jumping.
+
+    :param start: Start position (e.g. a servo pulse).
+    :param target: Target position.
+    :param max_velocity: Maximum velocity in units per second.
+    :param max_acceleration: Maximum acceleration in units per second squared.
+    :param profile: "trapezoid" or "s-curve".
+    :param jerk_time: Acceleration ramp time of the s-curve profile in seconds.
+    :param initial_velocity: Velocity at the start, e.g. of a move that is being preempted.
+    :param dt: Interval between two samples in seconds.
+    :param duration: Stretch the trajectory to this many seconds (to synchronize axes); ignored if shorter.
+                     A move from rest is slowed down uniformly, one with an initial velocity cruises slower.
+    :param position_limits: Optional (min, max) range of the axis. Braking from initial_velocity can
+                            overshoot the target; the samples are clipped so they never leave the range.
+    :return: A NumPy array of shape (n, 2) with (time since start, position) rows. The first row
+             is (0, start), the last one is exactly target.
+    """
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown profile {profile!r}, expected one of {PROFILES}")
+    distance = float(target - start)
+    if distance == 0 and initial_velocity == 0:
+        return np.array([[0.0, float(start)]])
+
+    smoothing = jerk_time if profile == "s-curve" else 0.0
+    # The moving average carries initial_velocity on for half the window; plan for that
+    planned_distance = distance - initial_velocity * smoothing / 2
+    times, velocities = _trapezoid_knots(planned_distance, max_velocity, max_acceleration, initial_velocity)
+    if duration is not None and initial_velocity != 0 and times[-1] + smoothing < duration:
+        # Stretching time (below) would scale initial_velocity down too, a jump in velocity at
+        # the start. Lower the cruise velocity instead until the move takes duration.
+        low, high = max_velocity * 1e-3, max_velocity
+        slowest = _trapezoid_knots(planned_distance, low, max_acceleration, initial_velocity)
+        if slowest[0][-1] + smoothing <= duration:
+            times, velocities = slowest
+        else:
+            for _ in range(30):
+                middle = (low + high) / 2
+                knots = _trapezoid_knots(planned_distance, middle, max_acceleration, initial_velocity)
+                if knots[0][-1] + smoothing > duration:
+                    low = middle
+                else:
+                    high = middle
+                    times, velocities = knots
+    step = dt / OVERSAMPLING
+    fine_time = np.arange(0.0, times[-1] + smoothing + step, step)
+    velocity = np.interp(fine_time, times, velocities, right=0.0)
+    if smoothing > 0:
+        window = max(1, int(round(smoothing / step)))
+        padded = np.concatenate((np.full(window - 1, float(initial_velocity)), velocity))
+        # Moving average as a difference of running sums, O(n) whatever the window
+        running = np.concatenate(([0.0], np.cumsum(padded)))
+        velocity = (running[window:] - running[:-window]) / window
+
+    position = np.concatenate(([0.0], np.cumsum((velocity[1:] + velocity[:-1]) / 2 * step)))
+    # Spread the integration error over the move so it ends exactly on the target
+    position += (distance - position[-1]) * fine_time / fine_time[-1]
+    total = fine_time[-1]
+
+    if duration is not None and duration > total and initial_velocity == 0:
+        stretched = np.arange(0.0, duration + step, step)
+        position = np.interp(stretched * total / duration, fine_time, position)
+        fine_time = stretched
+        total = duration
+
+    sample_time = np.append(np.arange(0.0, total, dt), total)
+    samples = np.column_stack((sample_time, start + np.interp(sample_time, fine_time, position)))
+    samples[-1, 1] = target
+    if position_limits is not None:
+        np.clip(samples[:, 1], position_limits[0], position_limits[1], out=samples[:, 1])
+    return samples
+
+
+def step_times(steps, max_velocity, max_acceleration, profile="trapezoid", jerk_time=0.1, duration=None):
+    """
+    Precomputes when each step of a stepper move from rest to rest is due.
+
+    :param steps: Number of steps (the sign is ignored).
+    :param max_velocity: Maximum velocity in steps per second.
+    :param max_acceleration: Maximum acceleration in steps per second squared.
+    :param profile: "trapezoid" or "s-curve".
+    :param jerk_time: Acceleration ramp time of the s-curve profile in seconds.
+    :param duration: Stretch the move to this many seconds; ignored if shorter.
+    :return: A NumPy array of (time since start, step number) rows, one per step.
+    """
+    steps = abs(int(steps))
+    if steps == 0:
+        return np.empty((0, 2))
+    # A fine trajectory, inverted: the time at which the position reaches every whole step
+    trajectory = plan_trajectory(0, steps, max_velocity, max_acceleration, profile, jerk_time,
+                                 dt=0.001, duration=duration)
+    position = np.maximum.accumulate(trajectory[:, 1])
+    step_numbers = np.arange(1, steps + 1, dtype=float)
+    return np.column_stack((np.interp(step_numbers, position, trajectory[:, 0]), step_numbers))
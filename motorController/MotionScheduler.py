@@ -0,0 +1,131 @@
+import time
+
+from LatencyTracer import NO_TRACE
+
+STEPPER_CHANNEL = 6
+# A combined move starts this long after it is accepted, so the servo and the stepper worker
+# have both picked it up by then and start on the same tick. It starts later if the stepper
+# is still busy: unlike the servos, it cannot preempt the move in progress.
+START_DELAY = 0.03
+
+
+class MotionScheduler:
+    """
+    Single entry point for moves of all seven axes: the servos on channels 0-5 (ServoController)
+    and the base stepper on channel 6 (StepperController). A move with targets for both kinds of
+    actuator is planned on one timeline: every axis starts at the same time and, if synchronized,
+    all of them arrive together in the time of the slowest one.
+    """
+
+    def __init__(self, servo_controller, stepper_controller):
+        self.servo_controller = servo_controller
+        self.stepper_controller = stepper_controller
+
+    def move_to(self, targets, synchronized=True, trace=NO_TRACE):
+        """
+        Moves several axes to absolute positions together.
+
+        :param targets: A dict of channel -> target (servo pulse, or steps for STEPPER_CHANNEL).
+        :param synchronized: Whether all axes should arrive at the same time.
+        :param trace: Latency trace of the command, see LatencyTracer.
+        :return: True if the move was accepted; nothing is moved if any target is invalid.
+        """
+        servo_targets = {channel: target for channel, target in targets.items() if channel != STEPPER_CHANNEL}
+        stepper_target = targets.get(STEPPER_CHANNEL)
+        if not self.servo_controller.check_targets(servo_targets):
+            return False
+        if stepper_target is not None and not self.stepper_controller.check_target(stepper_target):
+            return False
+
+        schedule = None
+        if servo_targets and stepper_target is not None:
+            duration = 0.0
+            if synchronized:
+                duration = max(self.servo_controller.move_duration(servo_targets),
+                               self.stepper_controller.move_duration(stepper_target))
+            start_time = max(time.monotonic() + START_DELAY, self.stepper_controller.idle_at())
+            schedule = (start_time, duration)
+            print(f"Scheduled move: {targets} in {duration:.2f}s, starting in {start_time - time.monotonic():.2f}s")
+        if servo_targets:
+            self.servo_controller.move_servos_to_positions(servo_targets, synchronized, schedule, trace)
+        if stepper_target is not None:
+            self.stepper_controller.move_stepper_to_position(stepper_target, schedule, trace)
+        return True
+
+    def move_by(self, channel, amount, trace=NO_TRACE):
+        """
+        Moves one axis relative to where the queued moves leave it.
+
+        :param channel: The channel of the axis.
+        :param amount: Pulses (servo) or steps (stepper), negative for the other direction.
+        :param trace: Latency trace of the command, see LatencyTracer.
+        """
+        if channel == STEPPER_CHANNEL:
+            self.stepper_controller.move_stepper_direction(amount, trace)
+        else:
+            self.servo_controller.move_servo_direction(channel, amount, trace)
+
+    def move_home(self, trace=NO_TRACE):
+        """
+        Moves all servos to their default positions.
+
+        :param trace: Latency trace of the command, see LatencyTracer.
+        """
+        self.servo_controller.move_default_servo_position(trace)
+
+    def cancel(self):
+        """
+        Drops all queued moves of every axis and stops the moves in progress.
+        """
+        self.servo_controller.cancel_movements()
+        self.stepper_controller.cancel_movements()
+
+    def submit(self, commands, trace=NO_TRACE):
+        """
+        Runs commands of the "channel:move:amount" protocol. All absolute moves (move 0) among
+        them form one combined move; relative moves (1) and homing of the servos (2, servo
+        channels only) run on their own.
+
+        :param commands: A list of (channel, move, amount).
+        :param trace: Latency trace of the message, see LatencyTracer.
+        """
+        targets = {}
+        for channel, move, amount in commands:
+            if move == 0:
+                targets[channel] = amount
+            elif move == 1:
+                self.move_by(channel, amount, trace)
+            elif move == 2 and channel != STEPPER_CHANNEL:
+                self.move_home(trace)
+            else:  # Unknown moves, and move 2 on the stepper, which has no home position
+                print("invalid move: " + str(move))
+        if len(targets) == 1:
+            (channel, target), = targets.items()
+            if channel == STEPPER_CHANNEL:
+                self.stepper_controller.move_stepper_to_position(target, trace=trace)
+            else:
+                self.servo_controller.move_servo_to_position(channel, target, trace)
+        elif targets:
+            self.move_to(targets, trace=trace)
+
+
+def parse_commands(payload):
+    """
+    Parses a message of the "channel:move:amount" protocol. Several commands may be joined by ",".
+    A fourth field, if present, is the publish time (time.time()) for latency tracing; it is the
+    same for every command of a message.
+
+    :param payload: The decoded message.
+    :return: (list of (channel, move, amount), publish time or None).
+    :raises ValueError: If a command is malformed.
+    """
+    commands = []
+    published_at = None
+    for command in payload.strip().split(","):
+        parsed = command.split(":")
+        if len(parsed) < 3:
+            raise ValueError(f"Expected channel:move:amount, got '{command}'")
+        commands.append((int(parsed[0]), int(parsed[1]), int(parsed[2])))
+        if len(parsed) > 3:
+            published_at = float(parsed[3])
+    return commands, published_at
@@ -0,0 +1,146 @@
+import collections
+import threading
+import time
+
+
+class LatencyStats:
+    """
+    Running statistics of a latency in seconds (count, mean, maximum and the most recent value).
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def add(self, seconds):
+        """
+        Records one latency sample.
+
+        :param seconds: The measured latency in seconds.
+        """
+        with self.__lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.last = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        """
+        :return: A short human readable summary in milliseconds.
+        """
+        return f"n={self.count} mean={self.mean * 1000:.2f}ms max={self.max * 1000:.2f}ms last={self.last * 1000:.2f}ms"
+
+
+class MovementQueue:
+    """
+    Thread-safe FIFO queue of movement commands backed by a deque. A worker blocks in get()
+    on a condition variable until a command arrives or the queue is closed, so an idle worker
+    uses no CPU. The time every command spent waiting in the queue is recorded in
+    start_latency.
+    """
+
+    def __init__(self):
+        self.__items = collections.deque()  # (enqueue time, command)
+        self.__condition = threading.Condition()  # Reentrant, see lock
+        self.__closed = False
+        self.start_latency = LatencyStats()
+
+    @property
+    def lock(self):
+        """
+        The queue's (reentrant) lock. Hold it to make reading the queued commands and
+        adding a new one atomic, or to update state together with get().
+        """
+        return self.__condition
+
+    def put(self, command):
+        """
+        Appends a command and wakes the worker.
+
+        :param command: The command to queue.
+        """
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__items.append((time.perf_counter(), command))
+            self.__condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest command, waiting until one is available. The wait in
+        the queue is recorded as the command's start latency.
+
+        :param timeout: Maximum time to wait in seconds, None to wait forever.
+        :return: The command, or None if the queue was closed or the timeout expired.
+        """
+        entry = self.get_entry(timeout)
+        if entry is None:
+            return None
+        enqueued_at, command = entry
+        self.record_start(enqueued_at)
+        return command
+
+    def get_entry(self, timeout=None):
+        """
+        Like get(), but returns (enqueue time, command) and records nothing, for workers that
+        start a command later than they take it. They call record_start() once it starts.
+
+        :param timeout: Maximum time to wait in seconds, 0 to not wait, None to wait forever.
+        :return: The entry, or None if the queue was closed or the timeout expired.
+        """
+        with self.__condition:
+            if timeout != 0:
+                self.__condition.wait_for(lambda: self.__items or self.__closed, timeout=timeout)
+            if self.__closed or not self.__items:
+                return None
+            return self.__items.popleft()
+
+    def record_start(self, enqueued_at):
+        """
+        Records the start latency of a command taken with get_entry().
+
+        :param enqueued_at: The enqueue time returned by get_entry().
+        """
+        self.start_latency.add(time.perf_counter() - enqueued_at)
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    def commands(self):
+        """
+        :return: A list of the queued commands, oldest first.
+        """
+        with self.__condition:
+            return [command for _, command in self.__items]
+
+    def clear(self):
+        """
+        Removes all queued commands.
+
+        :return: A list of the removed commands, oldest first.
+        """
+        with self.__condition:
+            removed = [command for _, command in self.__items]
+            self.__items.clear()
+            return removed
+
+    def close(self):
+        """
+        Closes the queue. Waiting and future get() calls return None, queued commands are dropped.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__items.clear()
+            self.__condition.notify_all()
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__items)
@@ -0,0 +1,96 @@
+# PCA9685 register map (see the datasheet, section 7.3)
+MODE1 = 0x00
+LED0_ON_L = 0x06
+AUTO_INCREMENT = 0x20  # MODE1 bit: the register pointer advances after every byte
+REGISTERS_PER_CHANNEL = 4  # ON_L, ON_H, OFF_L, OFF_H
+CHANNEL_COUNT = 16
+
+# SMBus block writes carry at most 32 data bytes, i.e. 8 channels
+MAX_BLOCK_CHANNELS = 32 // REGISTERS_PER_CHANNEL
+
+
+class PwmOutput:
+    """
+    Output stage for a PCA9685. Pulses are collected with set() during a control tick and
+    sent by flush(): channels whose pulse did not change are skipped, and changed channels
+    that are next to each other go out in one auto-increment block write instead of four
+    single-register writes each.
+    """
+
+    def __init__(self, device):
+        """
+        :param device: The I2C device of the PCA9685 (an Adafruit_GPIO.I2C.Device or anything
+                       with readU8(), write8() and writeList()).
+        """
+        self.__device = device
+        self.__pending = {}  # channel -> pulse set since the last flush
+        self.__written = [None] * CHANNEL_COUNT  # Last pulse sent per channel
+        self.transactions = 0  # I2C writes issued by flush()
+        self.flushes = 0  # flush() calls that wrote something
+
+    def enable_auto_increment(self):
+        """
+        Sets the auto-increment bit in MODE1, which block writes rely on. Call it after
+        changing the PWM frequency.
+        """
+        mode = self.__device.readU8(MODE1)
+        self.__device.write8(MODE1, mode | AUTO_INCREMENT)
+
+    def set(self, channel, pulse):
+        """
+        Stages a pulse for the next flush().
+
+        :param channel: The channel (0-15).
+        :param pulse: The off time in ticks of 4096 (0 switches the output off).
+        """
+        self.__pending[channel] = pulse
+
+    def written(self, channel):
+        """
+        :param channel: The channel (0-15).
+        :return: The last pulse sent to the channel, None if nothing was sent yet.
+        """
+        return self.__written[channel]
+
+    def flush(self):
+        """
+        Writes the staged pulses that differ from the last ones sent, one block write per run of
+        contiguous channels.
+
+        :return: The channels written, ascending (empty if nothing changed).
+        """
+        changed = sorted(channel for channel, pulse in self.__pending.items() if self.__written[channel] != pulse)
+        pending = self.__pending
+        self.__pending = {}
+        if not changed:
+            return changed
+
+        transactions = 0
+        run = [changed[0]]
+        for channel in changed[1:]:
+            if channel == run[-1] + 1 and len(run) < MAX_BLOCK_CHANNELS:
+                run.append(channel)
+            else:
+                self.__write_block(run, pending)
+                transactions += 1
+                run = [channel]
+        self.__write_block(run, pending)
+        transactions += 1
+
+        self.transactions += transactions
+        self.flushes += 1
+        return changed
+
+    def __write_block(self, channels, pending):
+        """
+        Writes ON and OFF registers of contiguous channels in one transfer (ON is always 0).
+
+        :param channels: The channels, ascending and without gaps.
+        :param pending: The dict of channel -> pulse to write.
+        """
+        data = []
+        for channel in channels:
+            pulse = pending[channel]
+            data += [0, 0, pulse & 0xFF, pulse >> 8]
+            self.__written[channel] = pulse
+        self.__device.writeList(LED0_ON_L + REGISTERS_PER_CHANNEL * channels[0], data)
@@ -1,29 +1,114 @@
 import threading
 import time
 
-import Adafruit_PCA9685
-import Adafruit_GPIO.I2C as I2C
+from ControlLoop import MOTION_TICK_RATE_ENV, TickTimer, configure_realtime
+from Hardware import create_hardware
+from LatencyTracer import NO_TRACE
+from MotionProfile import plan_trajectory
+from MovementQueue import MovementQueue
+from PwmOutput import PwmOutput
+
+LINKED_CHANNEL_SUM = 650  # Channel 5 mirrors channel 4: pulse_5 = 650 - pulse_4
+
+
+class Trajectory:
+    """
+    Precomputed move of one axis. samples holds (time since start, pulse) rows every dt
+    seconds, so the pulse at any time is found by indexing instead of being computed.
+
+    A move scheduled for later may have a lead-in: the move it replaces, which keeps driving
+    the axis until start_time. Without one, the axis holds the first sample until then.
+    """
+
+    def __init__(self, samples, start_time, dt, trace=NO_TRACE, lead_in=None):
+        self.trace = trace  # Latency trace of the command the move belongs to
+        self.samples = samples
+        self.start_time = start_time
+        self.dt = dt
+        self.duration = samples[-1, 0]
+        self.target_pulse = round(samples[-1, 1])
+        self.lead_in = lead_in
+
+    def __index_at(self, now):
+        return max(0, min(int((now - self.start_time) / self.dt + 1e-9), len(self.samples) - 1))
+
+    def __leading(self, now):
+        # The lead-in while it still drives the axis; dropped once this move has started
+        if now >= self.start_time:
+            self.lead_in = None
+        return self.lead_in
+
+    def started(self, now):
+        return now >= self.start_time
+
+    def pulse_at(self, now):
+        """
+        :param now: The current time (time.monotonic()).
+        :return: The pulse the axis should have at that time.
+        """
+        return round(self.position_at(now))
+
+    def position_at(self, now):
+        """
+        :param now: The current time (time.monotonic()).
+        :return: The planned, unrounded position at that time.
+        """
+        lead_in = self.__leading(now)
+        if lead_in is not None:
+            return lead_in.position_at(now)
+        if self.finished(now):
+            return self.samples[-1, 1]
+        return self.samples[self.__index_at(now), 1]
+
+    def velocity_at(self, now):
+        """
+        :param now: The current time (time.monotonic()).
+        :return: The planned velocity at that time in pulses per second (0 while a scheduled move waits).
+        """
+        lead_in = self.__leading(now)
+        if lead_in is not None:
+            return lead_in.velocity_at(now)
+        if now < self.start_time:
+            return 0.0
+        index = self.__index_at(now)
+        if index + 1 >= len(self.samples):
+            return 0.0
+        (t0, p0), (t1, p1) = self.samples[index], self.samples[index + 1]
+        return (p1 - p0) / (t1 - t0)
+
+    def finished(self, now):
+        return now >= self.start_time + self.duration
+
 
 class ServoController:
 
-    def __init__(self):
+    def __init__(self, hardware=None):
         """
         Initializes the ServoController class, setting up the PWM controller, servos,
         and their initial positions. Starts a thread to handle servo movements.
+
+        :param hardware: The hardware backend (see Hardware.py), None for the one selected by MOTOR_HARDWARE.
         """
-        self.__setup_pwm()
+        self.__setup_pwm(hardware or create_hardware())
         self.__setup_servos()
         self.__setup_initial_servo_position()
 
-        self.movement_queue = []
-        self.__queue_lock = threading.Lock()
+        self.movement_queue = MovementQueue()
 
         self.setup_sleep_time = 0.0
 
-        self.step_size = 1
-        self.sleep_time = 0.006
+        # Velocity profile of every move: "trapezoid" or "s-curve" (jerk limited, ramps acceleration over jerk_time)
+        self.profile = "s-curve"
+        self.jerk_time = 0.1
+        # All moving axes are advanced together once per tick, on fixed deadlines (MOTION_TICK_RATE)
+        self.tick_time = 1 / MOTION_TICK_RATE_ENV
+        self.tick_timer = TickTimer(self.tick_time)
+        # How far ahead of a servo a relative (joystick) target may run, in seconds of travel.
+        # Bounds how long the arm keeps moving after the stick is released.
+        self.max_lead_time = 0.2
+        self.coalesced_commands = 0  # Commands replaced by a newer one before they started
+        self.ticks = 0  # Control ticks that moved at least one servo
 
-        self.__move_servo_thread_running = True
         self.__move_servo_thread = threading.Thread(target=self.__move_servo_thread, daemon=True)
         self.__move_servo_thread.start()
 
@@ -31,13 +116,15 @@ class ServoController:
 
 
 
-    def __setup_pwm(self):
+    def __setup_pwm(self, hardware):
         """
-        Sets up the PWM controller with the specified address and frequency.
+        Sets up the PWM controller of the hardware backend.
+
+        :param hardware: The hardware backend.
         """
-        I2C.get_default_bus = lambda: 1
-        self.__pwm = Adafruit_PCA9685.PCA9685(address=0x40)
-        self.__pwm.set_pwm_freq(50)
+        # Pulses of a tick are written together, see PwmOutput
+        self.__output = PwmOutput(hardware.pwm_device())
+        self.__output.enable_auto_increment()
 
     def __setup_servos(self):
         """
@@ -53,6 +140,15 @@ class ServoController:
 
         self.__servos = [gripper, gripper_arm, upper_arm, middle_arm, lower_arm_a, lower_arm_b]
 
+        # channel: (max velocity in pulses/s, max acceleration in pulses/s²); channel 5 follows channel 4
+        self.__motion_limits = {
+            0: (400, 2500),
+            1: (300, 1500),
+            2: (250, 1000),
+            3: (300, 1200),
+            4: (200, 800),
+        }
+
     def __setup_initial_servo_position(self):
         """
         Initializes the current and current after move positions of the servos to their default values.
@@ -62,128 +158,368 @@ class ServoController:
         for servo in self.__servos:
             self.current_servo_position.append(servo[3])
             self.current_servo_position_after_move.append(servo[3])
+        # Position once every queued command has run; updated on enqueue, so reading it is O(1)
+        self.__predicted_position = self.current_servo_position_after_move.copy()
 
-    def move_servo_to_position(self, channel, target_pulse):
+    def move_servo_to_position(self, channel, target_pulse, trace=NO_TRACE):
         """
         Adds a movement command to the queue to move a servo to a specific position.
 
         :param channel: The channel of the servo to move.
         :param target_pulse: The target position for the servo.
+        :param trace: Latency trace of the command, see LatencyTracer.
         """
         if (channel >= 0) and (channel < len(self.__servos)-1):
             _, min_pulse, max_pulse, _ = self.__servos[channel]
             if min_pulse <= target_pulse <= max_pulse:
-                with self.__queue_lock:
-                    self.movement_queue.append((channel, target_pulse))
+                self.__enqueue({channel: target_pulse}, False, None, trace)
             else:
                 print("Pulse out of range!")
         else:
             print("Channel not available!")
 
-    def move_servo_direction(self, channel, direction):
+    def move_servos_to_positions(self, targets, synchronized=True, schedule=None, trace=NO_TRACE):
+        """
+        Adds one movement command for several servos to the queue. All servos start together;
+        if synchronized, they also arrive together, in the time the longest move needs.
+
+        :param targets: A dict of channel -> target pulse.
+        :param synchronized: Whether all servos should finish at the same time.
+        :param schedule: Optional (start time, duration): start no earlier than the start time
+                         (time.monotonic()) and take at least duration seconds, see MotionScheduler.
+        :param trace: Latency trace of the command, see LatencyTracer.
+        :return: True if the command was queued.
+        """
+        if not self.check_targets(targets):
+            return False
+        if targets:
+            self.__enqueue(dict(targets), synchronized, schedule, trace)
+        return True
+
+    def check_targets(self, targets):
+        """
+        Checks that every channel exists and every target is in range of its servo.
+
+        :param targets: A dict of channel -> target pulse.
+        :return: True if the targets are valid.
+        """
+        for channel, target_pulse in targets.items():
+            if not ((channel >= 0) and (channel < len(self.__servos)-1)):
+                print("Channel not available!")
+                return False
+            _, min_pulse, max_pulse, _ = self.__servos[channel]
+            if not (min_pulse <= target_pulse <= max_pulse):
+                print("Pulse out of range!")
+                return False
+        return True
+
+    def move_duration(self, targets):
+        """
+        Estimates how long a move from the predicted position to the targets takes, with every
+        servo starting at rest.
+
+        :param targets: A dict of channel -> target pulse.
+        :return: The duration of the slowest servo in seconds.
+        """
+        predicted = self.future_servo_position()
+        durations = [0.0]
+        for channel, target_pulse in targets.items():
+            axis = 4 if channel == 5 else channel
+            if channel == 5:
+                target_pulse = LINKED_CHANNEL_SUM - target_pulse
+            max_velocity, max_acceleration = self.__motion_limits[axis]
+            samples = plan_trajectory(predicted[axis], target_pulse, max_velocity, max_acceleration,
+                                      self.profile, self.jerk_time, dt=self.tick_time)
+            durations.append(samples[-1, 0])
+        return max(durations)
+
+    def move_servo_direction(self, channel, direction, trace=NO_TRACE):
         """
         Adds a movement command to the queue to move a servo in a specific direction.
 
         :param channel: The channel of the servo to move.
         :param direction: The direction to move the servo (positive or negative).
+        :param trace: Latency trace of the command, see LatencyTracer.
          """
-        _ , min_pulse, max_pulse, _ = self.__servos[channel]
-
         if (channel >= 0) and (channel < len(self.__servos)-1):
-            with self.__queue_lock:
-                servo_position = self.__future_servo_position()
-                if min_pulse >= servo_position[channel] + direction:
-                    self.movement_queue.append((channel, min_pulse))
-                if max_pulse <= servo_position[channel] + direction:
-                    self.movement_queue.append((channel, max_pulse))
+            _ , min_pulse, max_pulse, _ = self.__servos[channel]
+            max_lead = round(self.max_lead_time * self.__motion_limits[channel][0])
+            with self.movement_queue.lock:
+                predicted_pulse = self.__predicted_position[channel]
+                target_pulse = predicted_pulse + direction
+                # Repeated commands add up, but do not extend the target more than max_lead pulses
+                # ahead of the servo (an earlier target that is further away is kept)
+                current_pulse = self.current_servo_position[channel]
+                if direction > 0:
+                    target_pulse = min(target_pulse, max(predicted_pulse, current_pulse + max_lead))
                 else:
-                    self.movement_queue.append((channel, servo_position[channel] + direction))
+                    target_pulse = max(target_pulse, min(predicted_pulse, current_pulse - max_lead))
+                target_pulse = max(min_pulse, min(max_pulse, target_pulse))
+                self.__enqueue({channel: target_pulse}, False, None, trace)
         else:
             print("Channel not available!")
 
-    def __future_servo_position(self):
+    def __enqueue(self, targets, synchronized, schedule, trace):
+        """
+        Queues a movement command and books its targets as the predicted position.
+
+        :param targets: A dict of channel -> target pulse.
+        :param synchronized: Whether all servos should finish at the same time.
+        :param schedule: (start time, duration) or None, see move_servos_to_positions().
+        :param trace: Latency trace of the command.
+        """
+        with self.movement_queue.lock:
+            self.__apply_targets(self.__predicted_position, targets)
+            trace.add_part()
+            trace.mark("enqueue")
+            self.movement_queue.put((targets, synchronized, schedule, trace))
+
+    def future_servo_position(self):
         """
-        Calculates the future position of the servos after all queued movements are completed.
+        Returns the position of the servos after all queued movements are completed.
 
         :return: A list of the future positions of the servos.
         """
-        future_servo_position = self.current_servo_position_after_move.copy()
-        for channel, pulse in self.movement_queue:
+        with self.movement_queue.lock:
+            return self.__predicted_position.copy()
+
+    def cancel_movements(self):
+        """
+        Drops all queued movement commands and stops the servos where they are.
+        """
+        with self.movement_queue.lock:
+            dropped = self.movement_queue.clear()
+            self.coalesced_commands += len(dropped)
+            self.movement_queue.put((None, False, None, NO_TRACE))  # Tells the worker to stop the moves in progress
+            # The servos stop within one tick of their current pulse
+            self.__predicted_position = self.current_servo_position.copy()
+        for _, _, _, trace in dropped:
+            trace.part_done()  # Never started, like a coalesced command
+
+    @staticmethod
+    def __apply_targets(positions, targets):
+        """
+        Writes the targets of a command into a list of positions, mirroring channel 4 onto channel 5.
+
+        :param positions: The list of positions to update.
+        :param targets: A dict of channel -> pulse.
+        """
+        for channel, pulse in targets.items():
             if channel == 4 or channel == 5:
-                future_servo_position[4] = pulse
-                future_servo_position[5] = 650 - pulse
+                positions[4] = pulse
+                positions[5] = LINKED_CHANNEL_SUM - pulse
             else:
-                future_servo_position[channel] = pulse
+                positions[channel] = pulse
 
-        return future_servo_position
-
-    def move_default_servo_position(self):
+    def move_default_servo_position(self, trace=NO_TRACE):
         """
-        Moves all servos to their default positions in reverse order to start with the base.
+        Moves all servos to their default positions in one synchronized move.
+
+        :param trace: Latency trace of the command, see LatencyTracer.
         """
+        targets = {}
         for servo in reversed(self.__servos):
             channel = servo[0]
             default_pulse = servo[3]
             if 0 <= channel <= 4:
-                self.move_servo_to_position(channel, default_pulse)
-                time.sleep(self.setup_sleep_time)
+                targets[channel] = default_pulse
+        self.move_servos_to_positions(targets, synchronized=True, trace=trace)
+        time.sleep(self.setup_sleep_time)
 
-    def __move_servo_thread(self):
-        """
-        Continuously processes the movement queue and moves the servos to their target positions.
+    def __take_command(self, timeout):
         """
-        while self.__move_servo_thread_running:
-
-            if len(self.movement_queue) != 0:
-                with self.__queue_lock:
-                    channel, target_pulse = self.movement_queue.pop(0)
-                    if channel == 4 or channel == 5:
-                        self.current_servo_position_after_move[4] = target_pulse
-                        self.current_servo_position_after_move[5] = 650 - target_pulse
-                    else:
-                        self.current_servo_position_after_move[channel] = target_pulse
-
-                if (channel >= 0) and (channel < len(self.__servos)-1):
-                    print(f"Start to Move Servo: {channel} to {target_pulse}")
-
-                    _ , min_pulse, max_pulse, _ = self.__servos[channel]
-
-                    if min_pulse <= target_pulse <= max_pulse:
-
-                        if target_pulse < self.current_servo_position[channel]:
-                            current_step_size = -1 * self.step_size
-                        else:
-                            current_step_size = self.step_size
+        Takes the next command from the queue and books its targets as the after-move position.
 
-                        for pulse in range(self.current_servo_position[channel], target_pulse + current_step_size, current_step_size):
-                            if pulse > (target_pulse - current_step_size) and current_step_size > 0 or pulse < (target_pulse - current_step_size) and current_step_size < 0:
-                                pulse = target_pulse
+        :param timeout: Maximum time to wait in seconds, 0 to not wait, None to wait forever.
+        :return: (enqueue time, targets, synchronized, schedule, trace), or None.
+        """
+        # get_entry() releases the lock while waiting
+        with self.movement_queue.lock:
+            entry = self.movement_queue.get_entry(timeout)
+            if entry is None:
+                return None
+            enqueued_at, (targets, synchronized, schedule, trace) = entry
+            if targets is None:
+                self.current_servo_position_after_move = self.current_servo_position.copy()
+            else:
+                self.__apply_targets(self.current_servo_position_after_move, targets)
+        return enqueued_at, targets, synchronized, schedule, trace
 
-                            if channel == 4 or channel == 5:
-                                b_pulse = 650 - pulse
+    def __start_commands(self, commands, active, now):
+        """
+        Starts the axis moves of newly taken commands. Per servo only the newest command counts:
+        it replaces older commands that have not started yet and preempts a move in progress,
+        which then continues from the servo's current pulse and velocity. Channel 5 is driven
+        through channel 4. The whole trajectory of every axis is planned here, once per command.
+
+        :param commands: A list of (enqueue time, targets, synchronized, schedule, trace) in queue order.
+        :param active: The dict of channel -> Trajectory of the moving axes.
+        :param now: The current time (time.monotonic()).
+        :return: (trace, channels) of every started command, the channels being the axes it moves.
+        """
+        # A cancellation (targets None) stops every move and voids the commands before it
+        stops = [index for index, (_, targets, _, _, _) in enumerate(commands) if targets is None]
+        if stops:
+            for move in active.values():
+                move.trace.part_done()
+            active.clear()
+            self.coalesced_commands += stops[-1] - len(stops) + 1
+            for _, targets, _, _, trace in commands[:stops[-1]]:
+                if targets is not None:
+                    trace.part_done()
+            commands = commands[stops[-1] + 1:]
+
+        newest = {}
+        for command in commands:
+            for channel in self.__command_channels(command):
+                newest[channel] = command
+
+        started = []
+        for command in commands:
+            enqueued_at, targets, synchronized, schedule, trace = command
+            axes = {}
+            for channel, pulse in targets.items():
+                axis = 4 if channel == 5 else channel
+                if newest[axis] is command:
+                    axes[axis] = pulse
+            if not axes:
+                self.coalesced_commands += 1
+                trace.part_done()
+                continue
+
+            self.movement_queue.record_start(enqueued_at)
+            trace.mark("start")
+            trace.add_part(len(axes) - 1)  # One part per axis from here on
+            started.append((trace, set(axes)))
+            start_time, longest = now, 0.0
+            if schedule is not None:
+                start_time, longest = max(now, schedule[0]), schedule[1]
+            # A move that starts later lets the move in progress run until then (as its lead-in)
+            # and continues from where that move is at the start
+            starts = {channel: (active[channel].position_at(start_time), active[channel].velocity_at(start_time))
+                      if channel in active else (self.current_servo_position[channel], 0.0) for channel in axes}
+            plans = {channel: self.__plan(channel, pulse, *starts[channel]) for channel, pulse in axes.items()}
+            longest = max([longest] + [samples[-1, 0] for samples in plans.values()])
+            for channel, pulse in axes.items():
+                if synchronized and plans[channel][-1, 0] < longest:
+                    plans[channel] = self.__plan(channel, pulse, *starts[channel], longest)
+                lead_in = None
+                if channel in active:
+                    active[channel].trace.part_done()  # Preempted
+                    if start_time > now:
+                        lead_in = active[channel]
+                active[channel] = Trajectory(plans[channel], start_time, self.tick_time, trace, lead_in)
+            queued_ms = self.movement_queue.start_latency.last * 1000
+            print(f"Start to Move Servo: {axes} in {longest:.2f}s (queued {queued_ms:.1f} ms)")
+        return started
+
+    def __plan(self, channel, target_pulse, start_pulse, initial_velocity, duration=None):
+        """
+        Plans the trajectory of one servo from its position and velocity at the start of the move.
+        The trajectory stays within the servo's pulse range, even if braking overshoots the target.
+
+        :param channel: The channel of the servo (0-4).
+        :param target_pulse: The target pulse.
+        :param start_pulse: The servo's position at the start.
+        :param initial_velocity: The servo's velocity at the start, 0 if it is not moving.
+        :param duration: Stretch the move to this many seconds, None for the fastest move.
+        :return: The (time, pulse) samples, see MotionProfile.plan_trajectory().
+        """
+        max_velocity, max_acceleration = self.__motion_limits[channel]
+        _, min_pulse, max_pulse, _ = self.__servos[channel]
+        return plan_trajectory(start_pulse, target_pulse, max_velocity, max_acceleration,
+                               self.profile, self.jerk_time, initial_velocity, self.tick_time, duration,
+                               (min_pulse, max_pulse))
 
-                                self.__pwm.set_pwm(4, 0, pulse)
-                                self.__pwm.set_pwm(5, 0, b_pulse)
+    @staticmethod
+    def __command_channels(command):
+        return {4 if channel == 5 else channel for channel in command[1]}
 
-                                self.current_servo_position[4] = pulse
-                                self.current_servo_position[5] = b_pulse
+    def __write_pulse(self, channel, pulse):
+        """
+        Stages a pulse for a servo, mirroring channel 4 onto channel 5. It is sent (if it changed)
+        by the output flush at the end of the tick.
 
-                            else:
-                                self.__pwm.set_pwm(channel, 0, pulse)
-                                self.current_servo_position[channel] = pulse
+        :param channel: The channel of the servo.
+        :param pulse: The pulse to set.
+        """
+        self.current_servo_position[channel] = pulse
+        self.__output.set(channel, pulse)
+        if channel == 4:
+            self.current_servo_position[5] = LINKED_CHANNEL_SUM - pulse
+            self.__output.set(5, LINKED_CHANNEL_SUM - pulse)
 
-                            time.sleep(self.sleep_time)
-                    else:
-                        print("Pulse out of range!")
-                else:
-                    print("Channel not available!")
+    def __move_servo_thread(self):
+        """
+        Motion engine. Once per tick_time it takes all newly queued commands, starts them right
+        away (see __start_commands) and advances every moving servo toward its target, so moves
+        of different joints run at the same time. Ticks are paced by tick_timer. Sleeps on the
+        queue while idle and returns once the queue is closed.
+        """
+        configure_realtime("Servo motion thread")
+        active = {}  # channel -> Trajectory
+        awaiting_output = []  # (trace, channels) of started commands none of whose pulses was written yet
+        while True:
+            commands = []
+            if not active:
+                command = self.__take_command(timeout=None)
+                if command is None:
+                    break
+                commands.append(command)
+                self.tick_timer.start()
+            while True:
+                command = self.__take_command(timeout=0)
+                if command is None:
+                    break
+                commands.append(command)
+            if self.movement_queue.closed:
+                break
+
+            now = time.monotonic()
+            started = self.__start_commands(commands, active, now) if commands else []
+
+            finished = []
+            driven = set()  # Channels driven by their own move, not by a lead-in
+            for channel, move in list(active.items()):
+                self.__write_pulse(channel, move.pulse_at(now))
+                if move.started(now):
+                    driven.add(channel)
+                if move.finished(now):
+                    finished.append(move.trace)
+                    del active[channel]
+            written = set(self.__output.flush()) & driven
+            # A command reaches the output once a pulse of one of its channels is actually written;
+            # unchanged pulses (e.g. the first samples of an s-curve) are not sent
+            still_awaiting = []
+            for trace, channels in awaiting_output + started:
+                if channels & written:
+                    trace.mark("output")
+                elif any(channel in active and active[channel].trace is trace for channel in channels):
+                    still_awaiting.append((trace, channels))
+            awaiting_output = still_awaiting
+            for trace in finished:
+                trace.part_done()
+            self.ticks += 1
+
+            if active:
+                self.tick_timer.wait()
+
+    def loop_stats(self):
+        """
+        :return: The control loop statistics (jitter, work time, overruns), see TickTimer.stats().
+        """
+        return self.tick_timer.stats()
 
     def exit(self):
         """
         Stops the servo movement thread, disables the servos, and exits the program.
         """
-        self.__move_servo_thread_running = False
+        self.movement_queue.close()
         self.__move_servo_thread.join()
+        print(f"Servo enqueue-to-start latency: {self.movement_queue.start_latency.summary()}, {self.coalesced_commands} commands coalesced")
+        if self.ticks:
+            print(f"PWM output: {self.__output.transactions / self.ticks:.2f} I2C writes per tick over {self.ticks} ticks")
+        print(f"Control loop: {self.tick_timer.summary()}")
 
         self.__disable_servos()
         print("Exit ServoController")
@@ -195,7 +531,9 @@ class ServoController:
         for servo in self.__servos:
             channel = servo[0]
 
-            self.__pwm.set_pwm(channel, 0, 0)
+            self.__output.set(channel, 0)
             self.current_servo_position[channel] = 0
             self.current_servo_position_after_move[channel] = 0
+            self.__predicted_position[channel] = 0
+        self.__output.flush()
 
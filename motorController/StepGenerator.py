@@ -0,0 +1,147 @@
+import os
+import time
+
+import numpy as np
+
+# How step pulses are timed: "loop" from a Python loop, "wave" by hardware (pigpio waveforms on the Pi)
+STEP_GENERATOR_ENV = os.environ.get("STEP_GENERATOR", "loop")
+
+DIRECTION_SETUP_TIME = 0.001  # Wait after setting the direction before the first step (A4988: 200 ns)
+SPIN_TIME = 0.0005  # The loop generator sleeps until this close to a step, then busy-waits
+WAVE_POLL_TIME = 0.01  # How often the wave generator checks for a stop request
+START_POLL_TIME = 0.01  # How often a generator waiting for a scheduled start checks for a stop request
+
+
+def delay_table(times):
+    """
+    Turns precomputed step times into the delay before each step.
+
+    :param times: Step times in seconds since the start of the move (see MotionProfile.step_times()).
+    :return: A NumPy array of delays in microseconds, one per step.
+    """
+    return np.round(np.diff(times, prepend=0.0) * 1e6).astype(np.int64)
+
+
+def wait_for_start(start_at, should_stop):
+    """
+    Sleeps until a scheduled start in short slices, so a stop request does not have to wait
+    for it.
+
+    :param start_at: When the move starts (time.monotonic()).
+    :param should_stop: Checked between the slices.
+    :return: False if should_stop() returned True before the start.
+    """
+    while True:
+        if should_stop():
+            return False
+        delay = start_at - time.monotonic()
+        if delay <= 0:
+            return True
+        time.sleep(min(START_POLL_TIME, delay))
+
+
+class TimedLoopGenerator:
+    """
+    Makes the steps from a Python loop: sleeps until shortly before each step is due and
+    busy-waits the rest, which keeps the timing error well below the sleep jitter. A late step
+    delays the rest of the move instead of being caught up, so steps never come closer together
+    than planned (which could stall the motor).
+    """
+
+    def __init__(self, driver):
+        """
+        :param driver: The stepper driver (see Hardware.py).
+        """
+        self.__driver = driver
+        self.max_lateness = 0.0  # Latest step so far, in seconds after it was due
+
+    def run(self, clockwise, times, should_stop, start_at=None, on_first_step=None):
+        """
+        Makes the steps of one move.
+
+        :param clockwise: The direction of rotation.
+        :param times: Step times in seconds since the start of the move.
+        :param should_stop: Called before every step; the move ends early once it returns True.
+        :param start_at: When the move starts (time.monotonic()), None for right away.
+        :param on_first_step: Optional callable, called with the time (time.monotonic()) of the first step.
+        :return: The number of steps made.
+        """
+        self.__driver.set_direction(clockwise)
+        time.sleep(DIRECTION_SETUP_TIME)
+        if start_at is not None and not wait_for_start(start_at - SPIN_TIME, should_stop):
+            return 0
+        start = max(time.monotonic(), start_at or 0.0)
+        done = 0
+        for step_time in times:
+            if should_stop():
+                break
+            due = start + step_time
+            delay = due - time.monotonic()
+            if delay > SPIN_TIME:
+                time.sleep(delay - SPIN_TIME)
+            now = time.monotonic()
+            while now < due:
+                now = time.monotonic()
+            lateness = now - due
+            if lateness > 0:
+                self.max_lateness = max(self.max_lateness, lateness)
+                start += lateness
+            self.__driver.step()
+            done += 1
+            if done == 1 and on_first_step is not None:
+                on_first_step(now)
+        return done
+
+
+class WaveGenerator:
+    """
+    Hands the whole delay table of a move to a hardware-timed waveform (see Hardware.py), so
+    step timing does not depend on Python at all. The thread only waits for the end of the
+    waveform and checks for a stop request.
+    """
+
+    def __init__(self, driver, waveform):
+        """
+        :param driver: The stepper driver, used for the direction pin.
+        :param waveform: The waveform backend (play(), busy() and stop()).
+        """
+        self.__driver = driver
+        self.__waveform = waveform
+        self.max_lateness = 0.0  # Hardware timed
+
+    def run(self, clockwise, times, should_stop, start_at=None, on_first_step=None):
+        """
+        Makes the steps of one move, see TimedLoopGenerator.run().
+        """
+        if len(times) == 0:
+            return 0
+        self.__driver.set_direction(clockwise)
+        time.sleep(DIRECTION_SETUP_TIME)
+        if start_at is not None and not wait_for_start(start_at, should_stop):
+            return 0
+        played_at = time.monotonic()
+        self.__waveform.play(delay_table(times))
+        if on_first_step is not None:
+            on_first_step(played_at + times[0])  # The waveform starts with the delay before the first step
+        while self.__waveform.busy():
+            if should_stop():
+                break
+            time.sleep(WAVE_POLL_TIME)
+        return self.__waveform.stop()
+
+
+def create_step_generator(hardware, driver, step_pin, name=STEP_GENERATOR_ENV):
+    """
+    Creates the step generator selected by STEP_GENERATOR.
+
+    :param hardware: The hardware backend.
+    :param driver: Its stepper driver.
+    :param step_pin: The step pin (BCM numbering), for hardware-timed waveforms.
+    :param name: "loop" or "wave".
+    :return: A TimedLoopGenerator or WaveGenerator.
+    """
+    if name == "loop":
+        return TimedLoopGenerator(driver)
+    if name == "wave":
+        return WaveGenerator(driver, hardware.step_waveform(driver, step_pin))
+    raise ValueError(f"Unknown STEP_GENERATOR '{name}', expected 'loop' or 'wave'")
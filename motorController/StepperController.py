@@ -1,7 +1,12 @@
-from RpiMotorLib import RpiMotorLib
 import threading
 import time
-import RPi.GPIO as GPIO
+
+from ControlLoop import configure_realtime
+from Hardware import create_hardware
+from LatencyTracer import NO_TRACE
+from MotionProfile import step_times
+from MovementQueue import MovementQueue
+from StepGenerator import DIRECTION_SETUP_TIME, create_step_generator
 
 DIR_PIN = 22
 STEP_PIN = 27
@@ -9,80 +14,224 @@ EN_PIN = 17
 
 class StepperController:
 
-    def __init__(self):
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(DIR_PIN, GPIO.OUT)
-        GPIO.setup(STEP_PIN, GPIO.OUT)
-        GPIO.setup(EN_PIN, GPIO.OUT)
-        GPIO.output(EN_PIN, GPIO.HIGH)
-        GPIO_pins  = (-1, -1, -1)
+    def __init__(self, hardware=None):
+        hardware = hardware or create_hardware()
+        self.__driver = hardware.stepper_driver(DIR_PIN, STEP_PIN, EN_PIN)
+        self.__generator = create_step_generator(hardware, self.__driver, STEP_PIN)
         
-        self.movement_queue = []
+        self.movement_queue = MovementQueue()  # (absolute target in steps, schedule, trace, cancels), see add_queue_command
         self.is_running = False
         self.MAX_ROT = 650
         self.current_rot = 0
+        self.coalesced_commands = 0  # Targets replaced by a newer one before they started
+        # Velocity profile: "trapezoid" or "s-curve"; max velocity in steps/s, max acceleration in steps/s²
+        self.profile = "s-curve"
+        self.max_velocity = 600
+        self.max_acceleration = 1500
+        self.jerk_time = 0.1
+        self.__stop_requested = False
+        # Counts cancel_movements() calls; a move queued before the latest one is stopped
+        self.__cancels = 0
+        # Rotation once every queued command has run; updated on enqueue
+        self.__predicted_rot = self.current_rot
+        # Target and expected end (time.monotonic()) of the move in progress; a newly queued
+        # target is coalesced with any waiting one, so it starts from there at that time
+        self.__moving_to = self.current_rot
+        self.__busy_until = 0.0
         
-        self.direction = 22  # Direction -> GPIO Pin
-        self.step = 27  # Step -> GPIO Pin
         print("init stepper")
-        self.stepper_motor = RpiMotorLib.A4988Nema(self.direction, self.step, GPIO_pins , "A4988")
         
-        t = threading.Thread(target=self.__move_stepper_thread)
-        t.start()
+        self.__move_stepper_thread = threading.Thread(target=self.__move_stepper_thread, daemon=True)
+        self.__move_stepper_thread.start()
         
 
     def __test__(self):
         print("Starting Stepper motor test.")
-        self.stepper_motor.motor_go(False, "Full", 100, .01, False, .05)
+        self.__run_steps(False, 100)
         print("Stepper motor test completed.")
         
     def __move_stepper_thread(self):
-        GPIO.output(EN_PIN, GPIO.LOW)
-        while len(self.movement_queue) > 0:
+        """
+        Stepper worker. Sleeps on the queue while idle. Commands queued while the stepper moves
+        are coalesced: only the newest target is driven to once the move is done. The driver is
+        enabled while there is work and disabled when the queue runs empty.
+        """
+        configure_realtime("Stepper thread")
+        while True:
+            command = self.__take_target(timeout=None)
+            if command is None:
+                break
             self.is_running = True
-            move, pulse = self.movement_queue.pop()
-            
-            if move == 0:
-                self.move_stepper_to_position(pulse)
-            elif move == 1:
-                self.move_stepper_direction(pulse)
-            else: 
-                print("invalid move: "+ str(move))
-
-            print(f"current rot: {self.current_rot}")
-        GPIO.output(EN_PIN, GPIO.HIGH)
-        self.is_running = False
-    
-    def move_stepper_to_position(self, pulse):
+            self.__driver.set_enabled(True)
+            while command is not None:
+                target, schedule, trace, cancels = command
+                trace.mark("start")
+                steps = target - self.current_rot
+                with self.movement_queue.lock:
+                    self.__moving_to = target
+                cancelled = lambda: self.__cancels != cancels
+                if steps != 0 and not cancelled():
+                    print(f"move stepper to: {target}")
+                    done = self.__run_steps(steps > 0, abs(steps), schedule, lambda at: trace.mark("output", at),
+                                            lambda: self.__stop_requested or cancelled())
+                    self.current_rot += done if steps > 0 else -done
+                    print(f"current rot: {self.current_rot}")
+                if cancelled():
+                    with self.movement_queue.lock:
+                        self.__moving_to = self.current_rot
+                        self.__busy_until = time.monotonic()
+                        if not self.movement_queue.commands():
+                            self.__predicted_rot = self.current_rot  # Where the cancelled move stopped
+                trace.part_done()
+                command = self.__take_target(timeout=0)
+            self.__driver.set_enabled(False)
+            self.is_running = False
+
+    def __take_target(self, timeout):
+        """
+        Takes all queued targets and returns the newest one.
+
+        :param timeout: Maximum time to wait in seconds, 0 to not wait, None to wait forever.
+        :return: (target in steps, schedule, trace, cancels), or None if the queue is empty or closed.
+        """
+        target = self.movement_queue.get(timeout)
+        if target is None:
+            return None
+        while True:
+            newer = self.movement_queue.get(timeout=0)
+            if newer is None:
+                return target
+            target[2].part_done()  # Replaced before it started
+            if newer[1] is None and target[1] is not None:
+                # Keep the schedule of a combined move, the other axes rely on its start time
+                newer = (newer[0], target[1], newer[2], newer[3])
+            target = newer
+            self.coalesced_commands += 1
+
+    def move_stepper_to_position(self, pulse, schedule=None, trace=NO_TRACE):
+        """
+        Queues a move of the stepper to an absolute position.
+
+        :param pulse: The target position in steps (0 to MAX_ROT).
+        :param schedule: Optional (start time, duration): start no earlier than the start time
+                         (time.monotonic()) and take at least duration seconds, see MotionScheduler.
+        :param trace: Latency trace of the command, see LatencyTracer.
+        :return: True if the command was queued.
+        """
+        if not self.check_target(pulse):
+            return False
+        self.__enqueue(pulse, schedule, trace)
+        return True
+
+    def check_target(self, pulse):
+        """
+        :param pulse: A target position in steps.
+        :return: True if it is in range.
+        """
         if pulse < 0 or pulse > self.MAX_ROT:
             print(f"invalid pulse (0 < pulse < {self.MAX_ROT})")
-        else:
-            print(f"move stepper to: {pulse}")
-            self.stepper_motor.motor_go(pulse > self.current_rot, "Full", abs(pulse - self.current_rot), .01, False, .05)
-            self.current_rot = pulse
-                
-        
-     
-    def move_stepper_direction(self, pulse):
-        if (self.current_rot + pulse) < 0 or (self.current_rot + pulse) > self.MAX_ROT:
-            print(f"invalid pulse (0 < pulse + current_rot: {self.current_rot} < {self.MAX_ROT})")
-        else:
-            print(f"move stepper: {pulse}")
-            self.stepper_motor.motor_go(pulse > 0, "Full", abs(pulse), .01, False, .05)
-            self.current_rot += pulse
-            
-            
+            return False
+        return True
+
+    def move_duration(self, pulse):
+        """
+        Estimates how long a move to pulse takes once it is queued. It starts where the move in
+        progress ends, since waiting targets are coalesced into the new one.
+
+        :param pulse: The target position in steps.
+        :return: The duration in seconds.
+        """
+        with self.movement_queue.lock:
+            steps = pulse - self.__moving_to
+        times = step_times(steps, self.max_velocity, self.max_acceleration, self.profile, self.jerk_time)
+        return times[-1, 0] if len(times) else 0.0
+
+    def idle_at(self):
+        """
+        Estimates when a newly queued move can start: the end of the move in progress. The
+        stepper cannot preempt that move, see MotionScheduler.
+
+        :return: A time.monotonic() time, in the past if the stepper is idle.
+        """
+        with self.movement_queue.lock:
+            return self.__busy_until
+
+    def move_stepper_direction(self, pulse, trace=NO_TRACE):
+        """
+        Queues a move of the stepper relative to where the queued moves leave it.
+
+        :param pulse: The number of steps, negative to turn back.
+        :param trace: Latency trace of the command, see LatencyTracer.
+        """
+        with self.movement_queue.lock:
+            target = self.__predicted_rot + pulse
+            if target < 0 or target > self.MAX_ROT:
+                print(f"invalid pulse (0 < pulse + current_rot: {self.__predicted_rot} < {self.MAX_ROT})")
+            else:
+                self.__enqueue(target, None, trace)
+
+    def __enqueue(self, target, schedule, trace):
+        with self.movement_queue.lock:
+            self.__predicted_rot = target
+            trace.add_part()
+            trace.mark("enqueue")
+            self.movement_queue.put((target, schedule, trace, self.__cancels))
+
+    def __run_steps(self, clockwise, steps, schedule=None, on_first_step=None, should_stop=None):
+        """
+        Drives the stepper along a velocity profile. The time of every step is precomputed
+        before the first one and played by the step generator (see StepGenerator.py).
+
+        :param clockwise: The direction of rotation.
+        :param steps: The number of steps.
+        :param schedule: Optional (start time, duration), see move_stepper_to_position().
+        :param on_first_step: Optional callable, called with the time of the first step.
+        :param should_stop: Ends the move early once it returns True; None to only stop on exit().
+        :return: The number of steps made (fewer if stopped).
+        """
+        if should_stop is None:
+            should_stop = lambda: self.__stop_requested
+        start_at, duration = schedule or (None, None)
+        times = step_times(steps, self.max_velocity, self.max_acceleration, self.profile, self.jerk_time, duration)[:, 0]
+        with self.movement_queue.lock:
+            self.__busy_until = max(time.monotonic(), start_at or 0.0) + DIRECTION_SETUP_TIME + times[-1]
+        return self.__generator.run(clockwise, times, should_stop, start_at, on_first_step)
+
+    def cancel_movements(self):
+        """
+        Drops all queued targets and stops the move in progress after its current step.
+        """
+        with self.movement_queue.lock:
+            dropped = self.movement_queue.clear()
+            self.coalesced_commands += len(dropped)
+            self.__cancels += 1
+            # Corrected to where the stepper actually stops once the worker has stopped it
+            self.__predicted_rot = self.__moving_to
+        for _, _, trace, _ in dropped:
+            trace.part_done()  # Never started, like a coalesced command
+
     def add_queue_command(self,move,pulse):
-        self.movement_queue.append((move, pulse))
-        print(self.movement_queue)
-        
-        if not self.is_running:
-            self.__move_stepper_thread()
+        """
+        Queues a stepper command and returns right away; the worker thread runs it.
+
+        :param move: 0 to move to the absolute position pulse, 1 to move by pulse steps.
+        :param pulse: The position or number of steps.
+        """
+        if move == 0:
+            self.move_stepper_to_position(pulse)
+        elif move == 1:
+            self.move_stepper_direction(pulse)
+        else:
+            print("invalid move: "+ str(move))
 
     def exit(self):
         print("stop stepper")
-        self.stepper_motor.motor_stop()
-        GPIO.output(EN_PIN, GPIO.HIGH)
+        self.__stop_requested = True
+        self.movement_queue.close()
+        self.__move_stepper_thread.join()
+        print(f"Stepper enqueue-to-start latency: {self.movement_queue.start_latency.summary()}, {self.coalesced_commands} commands coalesced")
+        print(f"Latest step: {self.__generator.max_lateness * 1e6:.0f} us after it was due")
+        self.__driver.set_enabled(False)
 
 
 # def main():
@@ -93,7 +242,6 @@ class StepperController:
 #     stepper.add_queue_command(0,300)
 #     stepper.add_queue_command(0,10)
 #     stepper.__test__()
-#     GPIO.cleanup()
 
 
 
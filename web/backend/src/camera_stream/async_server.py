@@ -0,0 +1,340 @@
+# backend/src/camera_stream/async_server.py
+# asyncio (aiohttp) serving mode. Every viewer is a coroutine with a small
+# bounded buffer instead of a blocked OS thread, so a slow client only drops
+# its own stale frames and never delays the others.
+import asyncio
+import os
+
+from aiohttp import web
+
+from . import metrics
+from .broadcaster import create_broadcasters
+from .mjpeg import MIMETYPE, StreamOptions, index_html, encode_part, encode_ws_header, parse_query_arg, variant_etag
+from .replay import ReplayBuffer, replay_delays
+from .vision import VisionStage, create_vision_stage
+
+# Frames buffered per client before the oldest one is dropped
+CLIENT_BUFFER_SIZE = int(os.getenv("CLIENT_BUFFER_SIZE", "2"))
+
+# Per camera source, keyed by source name; the first one is the default source
+broadcasters_key = web.AppKey("broadcasters", dict)
+replays_key = web.AppKey("replays", dict)
+
+
+class ClientQueue:
+    """Bounded per-client frame buffer that drops the oldest frame when full."""
+
+    def __init__(self, client="unknown", maxsize=CLIENT_BUFFER_SIZE, count_drops=True):
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self.client = client
+        # Clients paced by ?fps skip frames on purpose; as in the Flask server those are not drops
+        self.count_drops = count_drops
+        self.dropped = 0
+
+    def put_latest(self, frame):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+            if self.count_drops:
+                metrics.frames_dropped.inc(self.client)
+        self._queue.put_nowait(frame)
+
+    async def get(self):
+        return await self._queue.get()
+
+    async def get_newest(self):
+        # Skips over anything still buffered; used by clients paced below the camera rate
+        frame = await self._queue.get()
+        while not self._queue.empty():
+            frame = self._queue.get_nowait()
+        return frame
+
+
+class FrameFanout:
+    """
+    Hands frames published by the broadcaster thread over to the event loop and
+    distributes them to every connected client queue.
+    """
+
+    def __init__(self, broadcaster, loop):
+        self._broadcaster = broadcaster
+        self._loop = loop
+        self._clients = set()
+
+    def start(self):
+        self._broadcaster.add_listener(self._on_frame)
+
+    def stop(self):
+        self._broadcaster.remove_listener(self._on_frame)
+
+    def subscribe(self, client="unknown", count_drops=True):
+        queue = ClientQueue(client, count_drops=count_drops)
+        latest = self._broadcaster.latest()
+        if latest is not None:
+            queue.put_latest(latest)
+        self._clients.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._clients.discard(queue)
+
+    def _on_frame(self, frame):
+        # Called from the broadcaster thread
+        self._loop.call_soon_threadsafe(self._dispatch, frame)
+
+    def _dispatch(self, frame):
+        for queue in self._clients:
+            queue.put_latest(frame)
+
+
+fanouts_key = web.AppKey("fanouts", dict)
+vision_key = web.AppKey("vision", VisionStage)
+
+
+async def add_cors_headers(request, response):
+    response.headers["Access-Control-Allow-Origin"] = "*"  # Allow requests from any origin
+
+
+def _client_name(request):
+    peer = request.transport.get_extra_info("peername") if request.transport else None
+    return f"{peer[0]}:{peer[1]}" if peer else (request.remote or "unknown")
+
+
+def _source(request):
+    # The source named in the route, or the default one
+    broadcasters = request.app[broadcasters_key]
+    name = request.match_info.get("name") or next(iter(broadcasters))
+    if name not in broadcasters:
+        raise web.HTTPNotFound(text=f"Unknown camera source '{name}'")
+    return name
+
+
+async def _client_frames(broadcaster, queue, options):
+    """Yields (frame, jpeg) for one client, applying its fps cap and size/quality variant."""
+    loop = asyncio.get_running_loop()
+    next_send = 0.0
+    while True:
+        delay = next_send - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+            frame = await queue.get_newest()
+        else:
+            frame = await queue.get()
+        next_send = max(next_send + options.interval, loop.time())
+        if options.width is None and options.quality is None:
+            jpeg = frame.jpeg
+        else:
+            # Variants share one encode per frame; keep it off the event loop
+            jpeg = await loop.run_in_executor(None, broadcaster.get_variant, frame, options.width, options.quality)
+        yield frame, jpeg
+
+
+def _release_client(fanout, queue):
+    fanout.unsubscribe(queue)
+    metrics.active_streams.dec()
+    metrics.frames_sent.remove(queue.client)
+    metrics.frames_dropped.remove(queue.client)
+
+
+async def video_feed_route(request):
+    name = _source(request)
+    try:
+        options = StreamOptions.from_args(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    response = web.StreamResponse(headers={"Content-Type": MIMETYPE})
+    await response.prepare(request)
+
+    fanout = request.app[fanouts_key][name]
+    queue = fanout.subscribe(_client_name(request), count_drops=not options.fps)
+    metrics.active_streams.inc()
+    try:
+        async for frame, jpeg in _client_frames(request.app[broadcasters_key][name], queue, options):
+            # write() waits for the socket to drain, which only blocks this client
+            await response.write(encode_part(frame, jpeg))
+            metrics.frames_sent.inc(queue.client)
+    except ConnectionResetError:
+        pass  # Client went away; cancellation propagates after the cleanup below
+    finally:
+        _release_client(fanout, queue)
+    return response
+
+
+async def websocket_route(request):
+    # Same frames as /video, but one binary message per frame prefixed with
+    # WS_FRAME_HEADER, so the client can measure latency and drop late frames.
+    name = _source(request)
+    try:
+        options = StreamOptions.from_args(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    fanout = request.app[fanouts_key][name]
+    queue = fanout.subscribe(_client_name(request), count_drops=not options.fps)
+    metrics.active_streams.inc()
+
+    async def send_frames():
+        async for frame, jpeg in _client_frames(request.app[broadcasters_key][name], queue, options):
+            await ws.send_bytes(encode_ws_header(frame) + jpeg)
+            metrics.frames_sent.inc(queue.client)
+
+    async def receive():
+        # Incoming messages are ignored; reading is needed to notice the close
+        async for _ in ws:
+            pass
+
+    sender = asyncio.create_task(send_frames())
+    receiver = asyncio.create_task(receive())
+    try:
+        # Whichever ends first (send failed or client closed) ends the connection
+        await asyncio.wait((sender, receiver), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        sender.cancel()
+        receiver.cancel()
+        # Retrieves the exceptions, so a failed send is reported here and not as "never retrieved"
+        for result in await asyncio.gather(sender, receiver, return_exceptions=True):
+            if isinstance(result, Exception) and not isinstance(result, ConnectionResetError):
+                print(f"ERROR in websocket stream: {result}")
+        _release_client(fanout, queue)
+    await ws.close()
+    return ws
+
+
+async def snapshot_route(request):
+    # Served from the latest published frame, never triggers a capture or encode of its own
+    broadcaster = request.app[broadcasters_key][_source(request)]
+    try:
+        options = StreamOptions.from_args(request.query)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    frame = broadcaster.latest()
+    if frame is None:
+        raise web.HTTPServiceUnavailable(text="No frame available yet", headers={"Retry-After": "1"})
+
+    etag = variant_etag(frame, options)
+    if request.if_none_match and any(tag.value in (etag, "*") for tag in request.if_none_match):
+        response = web.Response(status=304)
+    else:
+        jpeg = frame.jpeg
+        if options.width is not None or options.quality is not None:
+            jpeg = await asyncio.get_running_loop().run_in_executor(None, broadcaster.get_variant, frame, options.width, options.quality)
+        response = web.Response(body=jpeg, content_type="image/jpeg")
+    response.etag = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+async def replay_route(request):
+    replay_buffer = request.app[replays_key][_source(request)]
+    try:
+        seconds = parse_query_arg(request.query, "seconds", float, 0, replay_buffer.seconds)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+    response = web.StreamResponse(headers={"Content-Type": MIMETYPE})
+    await response.prepare(request)
+    try:
+        for delay, entry in replay_delays(replay_buffer.frames(seconds)):
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await response.write(encode_part(entry))
+    except ConnectionResetError:
+        pass
+    return response
+
+
+async def replay_export_route(request):
+    replay_buffer = request.app[replays_key][_source(request)]
+    try:
+        seconds = parse_query_arg(request.query, "seconds", float, 0, replay_buffer.seconds)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    # Disk I/O runs in the executor so streaming coroutines are not held up
+    path, frame_count, size = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: replay_buffer.export(seconds=seconds)
+    )
+    print(f"INFO: Exported {frame_count} replay frames to {path}.")
+    return web.json_response({"path": path, "frames": frame_count, "bytes": size})
+
+
+async def health_route(request):
+    # 200 once every camera delivers frames, 503 while any of them is still starting
+    broadcasters = request.app[broadcasters_key]
+    ready = all(broadcaster.ready for broadcaster in broadcasters.values())
+    sources = {
+        name: {"ready": broadcaster.ready, "time_to_first_frame": broadcaster.time_to_first_frame}
+        for name, broadcaster in broadcasters.items()
+    }
+    return web.json_response({"ready": ready, "sources": sources}, status=200 if ready else 503)
+
+
+async def metrics_route(request):
+    return web.Response(text=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def index_route(request):
+    return web.Response(text=index_html(list(request.app[broadcasters_key])), content_type="text/html")
+
+
+async def on_startup(app):
+    # Each broadcaster brings its camera up in the background; startup does not wait for them
+    loop = asyncio.get_running_loop()
+    broadcasters = create_broadcasters()
+    fanouts = {}
+    replays = {}
+    for name, broadcaster in broadcasters.items():
+        fanouts[name] = FrameFanout(broadcaster, loop)
+        fanouts[name].start()
+        replays[name] = ReplayBuffer()
+        broadcaster.add_listener(replays[name].append)
+        broadcaster.start()
+    app[broadcasters_key] = broadcasters
+    app[replays_key] = replays
+    app[fanouts_key] = fanouts
+    # Optional object/marker tracking in a separate process (VISION_DETECTOR)
+    vision_stage = create_vision_stage(broadcasters)
+    if vision_stage is not None:
+        await loop.run_in_executor(None, vision_stage.start)
+        app[vision_key] = vision_stage
+
+
+async def on_cleanup(app):
+    loop = asyncio.get_running_loop()
+    for fanout in app[fanouts_key].values():
+        fanout.stop()
+    stops = [broadcaster.stop for broadcaster in app[broadcasters_key].values()]
+    if vision_key in app:
+        stops.append(app[vision_key].stop)
+    # All stops are submitted at once, so every camera is released even if this is cancelled
+    await asyncio.gather(*(loop.run_in_executor(None, stop) for stop in stops))
+
+
+def create_app():
+    app = web.Application()
+    app.router.add_get("/video", video_feed_route)
+    app.router.add_get("/video/{name}", video_feed_route)
+    app.router.add_get("/ws", websocket_route)
+    app.router.add_get("/ws/{name}", websocket_route)
+    app.router.add_get("/snapshot", snapshot_route)
+    app.router.add_get("/snapshot/{name}", snapshot_route)
+    app.router.add_get("/replay", replay_route)
+    app.router.add_get("/replay/{name}", replay_route)
+    app.router.add_post("/replay/export", replay_export_route)
+    app.router.add_post("/replay/{name}/export", replay_export_route)
+    app.router.add_get("/health", health_route)
+    app.router.add_get("/metrics", metrics_route)
+    app.router.add_get("/", index_route)
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "5000"))
+    web.run_app(create_app(), host=host, port=port)
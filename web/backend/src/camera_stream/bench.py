@@ -0,0 +1,247 @@
+# backend/src/camera_stream/bench.py
+# Load test for the /video stream: opens N concurrent MJPEG clients and reports
+# delivered fps, capture-to-client latency, server encode time and throughput,
+# and server CPU.
+#
+#   uv run python -m camera_stream.bench --spawn flask --clients 8 --duration 20
+#   uv run python -m camera_stream.bench --spawn flask --resolution 1280x720 --encode-workers 3
+#   uv run python -m camera_stream.bench --url http://raspberrypi:5000/video --pid 1234
+import argparse
+import http.client
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+
+SERVER_MODULES = {"flask": "camera_stream.server", "async": "camera_stream.async_server"}
+
+
+class StreamClient(threading.Thread):
+    """Reads one MJPEG stream and records per-frame statistics from the part headers."""
+
+    def __init__(self, url, stop_event):
+        super().__init__(daemon=True)
+        self.url = url
+        self.stop_event = stop_event
+        self.frames = 0
+        self.bytes = 0
+        self.latencies = []  # Seconds between capture and receipt of the frame
+        self.encode_times = []  # Seconds the server spent encoding the frame
+        self.first_frame_at = None
+        self.last_frame_at = None
+        self.error = None
+
+    def run(self):
+        parts = urlsplit(self.url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=10)
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+            while not self.stop_event.is_set():
+                headers = self._read_part_headers(response)
+                jpeg = response.read(int(headers["content-length"]))
+                received = time.time()
+                response.read(4) # Trailing \r\n\r\n of the part
+
+                if self.first_frame_at is None:
+                    self.first_frame_at = received
+                self.last_frame_at = received
+                self.frames += 1
+                self.bytes += len(jpeg)
+                if "x-timestamp" in headers:
+                    self.latencies.append(received - float(headers["x-timestamp"]))
+                encode_ms = float(headers.get("x-encode-ms", "0"))
+                if encode_ms > 0:
+                    self.encode_times.append(encode_ms / 1000)
+        except Exception as e:
+            if not self.stop_event.is_set():
+                self.error = e
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _read_part_headers(response):
+        # Skip to the boundary, then collect headers up to the blank line
+        while True:
+            line = response.readline()
+            if not line:
+                raise ConnectionError("Stream closed by server")
+            if line.strip() == b"--frame":
+                break
+        headers = {}
+        while True:
+            line = response.readline().strip()
+            if not line:
+                return headers
+            name, _, value = line.decode("ascii").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    @property
+    def fps(self):
+        if self.frames < 2:
+            return 0.0
+        return (self.frames - 1) / (self.last_frame_at - self.first_frame_at)
+
+
+def process_cpu_seconds(pid):
+    # User + system CPU time of a process, from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def scrape_metric(base_url, name):
+    # Sums every sample of a metric on the server's /metrics page; None if unavailable
+    try:
+        with urllib.request.urlopen(f"{base_url}/metrics", timeout=2) as response:
+            text = response.read().decode()
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None
+    values = [float(line.rsplit(" ", 1)[1]) for line in text.splitlines()
+              if line.startswith(name) and line[len(name):len(name) + 1] in (" ", "{")]
+    return sum(values) if values else None
+
+
+def spawn_server(mode, port, extra_env=None):
+    env = dict(os.environ)
+    env.setdefault("USE_SYNTHETIC", "1")
+    env.update(extra_env or {})
+    env["PORT"] = str(port)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, env.get("PYTHONPATH")]))
+    process = subprocess.Popen(
+        [sys.executable, "-m", SERVER_MODULES[mode]], env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    # Wait until the server publishes its first frame
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/snapshot", timeout=1) as response:
+                if response.status == 200:
+                    return process
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server did not become ready within 30s")
+
+
+def run_benchmark(url, clients, duration, pid=None):
+    stop_event = threading.Event()
+    readers = [StreamClient(url, stop_event) for _ in range(clients)]
+    parts = urlsplit(url)
+    base_url = f"{parts.scheme}://{parts.netloc}"
+    encoded_start = scrape_metric(base_url, "camera_encode_seconds_count")
+    dropped_start = scrape_metric(base_url, "camera_encode_dropped_total")
+    cpu_start = process_cpu_seconds(pid) if pid else None
+    started = time.monotonic()
+    for reader in readers:
+        reader.start()
+    time.sleep(duration)
+    stop_event.set()
+    elapsed = time.monotonic() - started
+    cpu_end = process_cpu_seconds(pid) if pid else None
+    encoded_end = scrape_metric(base_url, "camera_encode_seconds_count")
+    dropped_end = scrape_metric(base_url, "camera_encode_dropped_total")
+    for reader in readers:
+        reader.join(timeout=2)
+
+    latencies = [latency for reader in readers for latency in reader.latencies]
+    encode_times = [t for reader in readers for t in reader.encode_times]
+    fps = [reader.fps for reader in readers]
+    return {
+        "clients": clients,
+        "errors": [str(reader.error) for reader in readers if reader.error],
+        "frames": sum(reader.frames for reader in readers),
+        "mbit_per_s": sum(reader.bytes for reader in readers) * 8 / elapsed / 1e6,
+        "fps_mean": statistics.fmean(fps) if fps else 0.0,
+        "fps_min": min(fps, default=0.0),
+        "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+        "latency_p95_ms": percentile(latencies, 0.95) * 1000,
+        "latency_max_ms": max(latencies, default=0.0) * 1000,
+        "encode_mean_ms": statistics.fmean(encode_times) * 1000 if encode_times else 0.0,
+        # Includes variant encodes, which /metrics does not tell apart
+        "encoded_fps": (encoded_end - encoded_start) / elapsed if encoded_start is not None and encoded_end is not None else None,
+        # Labelled per source, so there are no samples until the first drop
+        "encode_dropped": (dropped_end or 0) - (dropped_start or 0),
+        "server_cpu_percent": (cpu_end - cpu_start) / elapsed * 100 if cpu_start is not None and cpu_end is not None else None,
+    }
+
+
+def print_report(result):
+    print(f"clients:            {result['clients']}")
+    print(f"frames received:    {result['frames']}")
+    print(f"delivered fps:      mean {result['fps_mean']:.1f}, slowest client {result['fps_min']:.1f}")
+    print(f"throughput:         {result['mbit_per_s']:.1f} Mbit/s")
+    print(f"latency (capture->client): p50 {result['latency_p50_ms']:.1f} ms, "
+          f"p95 {result['latency_p95_ms']:.1f} ms, max {result['latency_max_ms']:.1f} ms")
+    print(f"encode time:        {result['encode_mean_ms']:.2f} ms/frame")
+    if result["encoded_fps"] is not None:
+        print(f"encode throughput:  {result['encoded_fps']:.1f} frames/s, {result['encode_dropped']:.0f} dropped as stale")
+    if result["server_cpu_percent"] is not None:
+        print(f"server CPU:         {result['server_cpu_percent']:.0f} %")
+    for error in result["errors"]:
+        print(f"client error:       {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the camera_stream MJPEG endpoint.")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", default="http://127.0.0.1:5000/video", help="Stream URL of a running server")
+    target.add_argument("--spawn", choices=sorted(SERVER_MODULES), help="Start a server with the synthetic source")
+    parser.add_argument("--port", type=int, default=5055, help="Port for --spawn")
+    parser.add_argument("--query", default="", help="Query string for every client, e.g. 'fps=10&width=320'")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to measure")
+    parser.add_argument("--pid", type=int, help="PID of the server process to sample CPU usage from")
+    parser.add_argument("--resolution", help="Camera resolution for --spawn, e.g. 1280x720")
+    parser.add_argument("--encode-workers", type=int, help="JPEG encode workers for --spawn")
+    args = parser.parse_args(argv)
+
+    server_env = {}
+    if args.resolution:
+        width, _, height = args.resolution.partition("x")
+        server_env.update(CAMERA_WIDTH=width, CAMERA_HEIGHT=height)
+    if args.encode_workers:
+        server_env["ENCODE_WORKERS"] = str(args.encode_workers)
+
+    process = None
+    url, pid = args.url, args.pid
+    if args.spawn:
+        process = spawn_server(args.spawn, args.port, server_env)
+        url, pid = f"http://127.0.0.1:{args.port}/video", process.pid
+    if args.query:
+        url = f"{url}?{args.query}"
+
+    try:
+        print_report(run_benchmark(url, args.clients, args.duration, pid))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
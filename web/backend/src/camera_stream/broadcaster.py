@@ -0,0 +1,335 @@
+# backend/src/camera_stream/broadcaster.py
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+
+from . import metrics
+from .camera import ENCODE_BUDGET_ENV, ENCODE_MAX_LAG_ENV, ENCODE_WORKERS_ENV, IDLE_FPS_ENV, create_cameras, create_change_detector, encode_frame, resize_frame
+from .encoder import EncodeScheduler, EncoderPool
+
+
+@dataclass(frozen=True)
+class Frame:
+    seq: int          # Increases by one for every published frame
+    timestamp: float  # Wall-clock capture time (time.time())
+    jpeg: bytes
+    image: object = field(default=None, repr=False, compare=False)  # Raw frame, kept for variants
+    etag: str = ""    # Content hash of jpeg, unchanged when a static frame is republished
+    encode_time: float = 0.0  # Seconds spent in the JPEG encode, 0 when the previous JPEG was reused
+
+
+class _PendingVariant:
+    def __init__(self):
+        self.done = threading.Event()
+        self.jpeg = None
+
+
+class VariantCache:
+    """
+    Caches re-encoded (width, quality) variants of the most recent frames, so every
+    distinct variant is encoded once per frame sequence no matter how many clients
+    ask for it. Concurrent requests for the same variant wait for the first encode.
+    """
+
+    def __init__(self, encode=encode_frame, resize=resize_frame, keep_frames=2):
+        self._encode = encode
+        self._resize = resize
+        self._keep_frames = keep_frames
+        self._lock = threading.Lock()
+        self._entries = {}  # (seq, width, quality) -> _PendingVariant
+
+    def get(self, frame, width=None, quality=None):
+        if (width is None and quality is None) or frame.image is None:
+            return frame.jpeg
+
+        key = (frame.seq, width, quality)
+        with self._lock:
+            entry = self._entries.get(key)
+            owner = entry is None
+            if owner:
+                entry = _PendingVariant()
+                self._entries[key] = entry
+                self._evict(frame.seq)
+
+        if not owner:
+            entry.done.wait()
+            return entry.jpeg
+
+        try:
+            entry.jpeg = self._encode(self._resize(frame.image, width), quality)
+        finally:
+            entry.done.set()
+        return entry.jpeg
+
+    def _evict(self, newest_seq):
+        oldest_kept = newest_seq - self._keep_frames + 1
+        for key in [key for key in self._entries if key[0] < oldest_kept]:
+            del self._entries[key]
+
+
+class FrameBroadcaster:
+    """
+    Captures and encodes frames on a single background thread and publishes the
+    newest one into a shared slot. Any number of viewers can wait on the slot,
+    so the capture + JPEG encode cost does not grow with the number of clients.
+    There is one broadcaster per camera source.
+    """
+
+    def __init__(self, capture, encode=encode_frame, detector=None, idle_fps=0.0, keyframe_interval=10.0,
+                 encode_workers=1, encode_max_lag=None, initialize=None, cleanup=None, name="default", scheduler=None):
+        self.name = name
+        self._capture = capture
+        self._encode = encode
+        self._cleanup = cleanup
+        # Shared by the broadcasters of all sources to cap their total encode time
+        self._scheduler = scheduler
+        # The camera is brought up on the broadcaster thread, so servers can start
+        # accepting requests right away; streams attach once the first frame arrives.
+        self._initialize = initialize
+        self._started_at = None
+        self.time_to_first_frame = None
+        # With more than one worker, capture stays on this thread while a pool encodes
+        # and a publisher thread emits the results in capture order.
+        self._encode_workers = encode_workers
+        self._encode_max_lag = encode_max_lag
+        self._encoder = None
+        self._publisher_thread = None
+        # Static scenes are neither re-encoded nor re-sent; the last JPEG is republished
+        # every keyframe_interval seconds so viewers still see a fresh timestamp.
+        self._detector = detector
+        self._idle_fps = idle_fps
+        self._keyframe_interval = keyframe_interval
+        self._cond = threading.Condition()
+        self._latest = None
+        self._seq = 0
+        self._running = False
+        self._thread = None
+        self._listeners = []
+        self._variants = VariantCache(encode=self._encode_image)
+
+    def add_listener(self, callback):
+        """
+        Registers callback(frame) to be called from the broadcaster thread for every
+        published frame. Callbacks must return quickly; they run on the capture path.
+        """
+        with self._cond:
+            self._listeners = self._listeners + [callback]
+
+    def remove_listener(self, callback):
+        with self._cond:
+            # == rather than `is`: bound methods are recreated on every attribute access
+            self._listeners = [cb for cb in self._listeners if cb != callback]
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._started_at = time.monotonic()
+        self.time_to_first_frame = None
+        if self._encode_workers > 1:
+            self._encoder = EncoderPool(self._encode_image, self._encode_workers, self._encode_max_lag, source=self.name)
+            self._publisher_thread = threading.Thread(target=self._run_publisher, name=f"frame-publisher-{self.name}", daemon=True)
+            self._publisher_thread.start()
+        if self._scheduler is not None:
+            self._scheduler.register(self.name)
+        self._thread = threading.Thread(target=self._run, name=f"frame-broadcaster-{self.name}", daemon=True)
+        self._thread.start()
+        print(f"INFO: Frame broadcaster '{self.name}' started.")
+
+    def stop(self):
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._encoder is not None:
+            self._encoder.close()
+            self._publisher_thread.join(timeout=2)
+            self._encoder = None
+            self._publisher_thread = None
+        if self._scheduler is not None:
+            self._scheduler.unregister(self.name)
+        if self._cleanup is not None:
+            self._cleanup()
+        print(f"INFO: Frame broadcaster '{self.name}' stopped.")
+
+    @property
+    def running(self):
+        return self._running
+
+    @property
+    def ready(self):
+        """True once the first frame has been published."""
+        return self.time_to_first_frame is not None
+
+    def latest(self):
+        """Returns the most recently published Frame, or None if there is none yet."""
+        with self._cond:
+            return self._latest
+
+    def get_variant(self, frame, width=None, quality=None):
+        """Returns the JPEG of frame downscaled to width and encoded at quality, encoding it at most once."""
+        return self._variants.get(frame, width, quality)
+
+    def wait_for_frame(self, last_seq=0, timeout=None):
+        """
+        Blocks until a frame newer than last_seq is published and returns it.
+        Returns None on timeout or when the broadcaster is stopped.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: not self._running or (self._latest is not None and self._latest.seq > last_seq),
+                timeout=timeout,
+            )
+            if self._latest is not None and self._latest.seq > last_seq:
+                return self._latest
+            return None
+
+    def _publish(self, timestamp, jpeg, image=None, encode_time=0.0):
+        with self._cond:
+            previous = self._latest
+            if previous is not None and previous.jpeg is jpeg:
+                etag = previous.etag
+            else:
+                etag = f"{zlib.crc32(jpeg):08x}-{len(jpeg):x}"
+            self._seq += 1
+            frame = Frame(self._seq, timestamp, jpeg, image, etag, encode_time)
+            self._latest = frame
+            listeners = self._listeners
+            if self.time_to_first_frame is None:
+                self.time_to_first_frame = time.monotonic() - self._started_at
+                metrics.time_to_first_frame.set(self.time_to_first_frame, self.name)
+                print(f"INFO: [{self.name}] First frame published {self.time_to_first_frame:.2f}s after start.")
+            self._cond.notify_all()
+        for callback in listeners:
+            try:
+                callback(frame)
+            except Exception as e:
+                print(f"ERROR in frame listener: {e}")
+
+    def _encode_image(self, image, quality=None):
+        # Every encode of this source, including variants, counts against its budget
+        started = time.perf_counter()
+        jpeg = self._encode(image) if quality is None else self._encode(image, quality)
+        elapsed = time.perf_counter() - started
+        metrics.encode_seconds.observe(elapsed, self.name)
+        if self._scheduler is not None:
+            self._scheduler.charge(self.name, elapsed)
+        return jpeg
+
+    def _reset_detector(self):
+        # The detector took the last frame as its reference, but it was not published. Forget
+        # it so the next capture counts as changed instead of matching an image nobody saw.
+        if self._detector is not None:
+            self._detector.reset()
+
+    def _idle_wait(self, until):
+        # Sleeps until the given monotonic time, waking early on stop()
+        with self._cond:
+            self._cond.wait_for(lambda: not self._running, timeout=max(0.0, until - time.monotonic()))
+
+    def _initialize_camera(self):
+        # Retries with a growing delay until the camera comes up or stop() is called
+        delay = 1.0
+        while self._running:
+            try:
+                self._initialize()
+                return True
+            except Exception as e:
+                print(f"ERROR: [{self.name}] Camera initialization failed, retrying in {delay:.0f}s: {e}")
+            self._idle_wait(time.monotonic() + delay)
+            delay = min(delay * 2, 30.0)
+        return False
+
+    def _run(self):
+        if self._initialize is not None and not self._initialize_camera():
+            return
+        last_publish = 0.0
+        while self._running:
+            try:
+                started = time.monotonic()
+                frame = self._capture()
+                timestamp = time.time()
+                if frame is None:
+                    time.sleep(0.1) # Short delay before retrying
+                    continue
+
+                changed = self._detector is None or self._detector.has_changed(frame)
+                latest = self.latest()
+                if not changed and latest is not None:
+                    metrics.unchanged_frames.inc(self.name)
+                    if started - last_publish >= self._keyframe_interval:
+                        self._publish(timestamp, latest.jpeg, latest.image)
+                        last_publish = started
+                    if self._idle_fps > 0:
+                        self._idle_wait(started + 1.0 / self._idle_fps)
+                    continue
+
+                if self._scheduler is not None and not self._scheduler.may_encode(self.name):
+                    # Over budget: skip this frame, the next capture is newer anyway
+                    metrics.encode_throttled.inc(self.name)
+                    self._reset_detector()
+                    continue
+
+                if self._encoder is not None:
+                    self._encoder.submit(timestamp, frame)
+                    last_publish = started
+                    continue
+
+                encode_started = time.perf_counter()
+                jpeg = self._encode_image(frame)
+                encode_time = time.perf_counter() - encode_started
+                if jpeg is None:
+                    self._reset_detector()
+                    continue
+                self._publish(timestamp, jpeg, frame, encode_time)
+                last_publish = started
+            except Exception as e:
+                print(f"ERROR in frame broadcaster loop [{self.name}]: {e}")
+                self._reset_detector()  # The frame that failed may already be the detector's reference
+                time.sleep(1) # Longer delay if there's an exception
+
+    def _run_publisher(self):
+        encoder = self._encoder
+        while self._running:
+            try:
+                encoded = encoder.next_encoded(timeout=0.5)
+                if encoded is None:
+                    continue
+                timestamp, image, jpeg, encode_time = encoded
+                if jpeg is None:
+                    self._reset_detector()
+                    continue
+                self._publish(timestamp, jpeg, image, encode_time)
+            except Exception as e:
+                print(f"ERROR in frame publisher loop [{self.name}]: {e}")
+                time.sleep(1)
+
+
+def create_broadcaster(camera, scheduler=None):
+    """Creates a FrameBroadcaster for one camera source, applying the environment settings."""
+    return FrameBroadcaster(
+        capture=camera.capture,
+        detector=create_change_detector(),
+        idle_fps=IDLE_FPS_ENV,
+        encode_workers=ENCODE_WORKERS_ENV,
+        encode_max_lag=ENCODE_MAX_LAG_ENV,
+        initialize=camera.initialize,
+        cleanup=camera.cleanup,
+        name=camera.name,
+        scheduler=scheduler,
+    )
+
+
+def create_broadcasters():
+    """
+    Creates one broadcaster per configured camera source, all sharing one encode
+    budget. Returns a dict keyed by source name, the default source first.
+    """
+    scheduler = EncodeScheduler(ENCODE_BUDGET_ENV)
+    return {camera.name: create_broadcaster(camera, scheduler) for camera in create_cameras()}
@@ -1,111 +1,359 @@
 # backend/src/pi_camera_app/camera.py
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 import cv2 # Needed for imencode in both modes
+import numpy as np
+
+from . import metrics
 
 USE_OPENCV_ENV = os.environ.get("USE_OPENCV", "0") == "1"
-_camera_initialized = False
-_opencv_cap = None
-_picam2_instance = None
-
-def initialize_camera():
-    global _camera_initialized, _opencv_cap, _picam2_instance, USE_OPENCV_ENV
-
-    if _camera_initialized:
-        return
-
-    if USE_OPENCV_ENV:
-        print("INFO: Initializing OpenCV camera (local development mode)...")
-        _opencv_cap = cv2.VideoCapture(0) # Try default camera
-        if not _opencv_cap.isOpened():
-            # Try common alternative indices if default fails
-            for i in range(1, 5):
-                print(f"INFO: Default camera not found, trying index {i}...")
-                _opencv_cap = cv2.VideoCapture(i)
-                if _opencv_cap.isOpened():
-                    break
-        if not _opencv_cap.isOpened():
-            _opencv_cap = None # Ensure it's None if all attempts fail
-            raise RuntimeError("Could not open any OpenCV video stream.")
-        print(f"INFO: OpenCV camera initialized using index for {_opencv_cap.getBackendName()}.")
-    else:
-        print("INFO: Initializing Picamera2 (Raspberry Pi mode)...")
-        try:
-            from picamera2 import Picamera2
-            _picam2_instance = Picamera2()
-            config = _picam2_instance.create_preview_configuration(
-                main={"size": (640, 480), "format": "RGB888"},
-                controls={"FrameRate": 30}
+# Synthetic source for benchmarks/CI: "pattern", a video file or a directory of images
+USE_SYNTHETIC_ENV = os.environ.get("USE_SYNTHETIC", "0") == "1"
+SYNTHETIC_SOURCE_ENV = os.environ.get("SYNTHETIC_SOURCE", "pattern")
+SYNTHETIC_FPS_ENV = float(os.environ.get("SYNTHETIC_FPS", "30"))
+# Index of the last OpenCV device that opened, tried first on the next start
+CAMERA_INDEX_CACHE_ENV = os.environ.get(
+    "CAMERA_INDEX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "camera_stream", "opencv_index")
+)
+# Named sources, e.g. "wrist=opencv:0,overview=picamera:1"; unset = one source from the flags above
+CAMERA_SOURCES_ENV = os.environ.get("CAMERA_SOURCES", "").strip()
+OPENCV_MAX_INDEX = 5
+PICAMERA_WARMUP_TIMEOUT = 2.0 # Seconds to wait for the first non-blank frame
+FRAME_SIZE = (int(os.environ.get("CAMERA_WIDTH", "640")), int(os.environ.get("CAMERA_HEIGHT", "480")))
+# JPEG encode workers; more than one spreads encoding over several cores (useful from 1280x720 up)
+ENCODE_WORKERS_ENV = max(1, int(os.environ.get("ENCODE_WORKERS", "1")))
+ENCODE_MAX_LAG_ENV = int(os.environ["ENCODE_MAX_LAG"]) if os.environ.get("ENCODE_MAX_LAG") else None # Frames
+# Change detection: skip re-encoding frames that look like the previous one
+CHANGE_DETECTION_ENV = os.environ.get("CHANGE_DETECTION", "1") == "1"
+CHANGE_THRESHOLD_ENV = float(os.environ.get("CHANGE_THRESHOLD", "0.005")) # Fraction of changed pixels
+IDLE_FPS_ENV = float(os.environ.get("IDLE_FPS", "0")) # Capture rate while the scene is static, 0 = no throttling
+# Total JPEG encode time all sources may use, in CPU seconds per second (0 = unlimited)
+ENCODE_BUDGET_ENV = float(os.environ.get("ENCODE_BUDGET", str(0.75 * (os.cpu_count() or 1))))
+
+class SyntheticSource:
+    """
+    Camera stand-in that needs no hardware. Generates a moving test pattern, or replays
+    a video file / directory of images in a loop, paced to the given frame rate.
+    """
+
+    IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+    def __init__(self, source="pattern", size=FRAME_SIZE, fps=30):
+        self.source = source
+        self.size = size
+        self._interval = 1.0 / fps if fps > 0 else 0.0
+        self._next_frame = time.monotonic()
+        self._index = 0
+        self._video = None
+        self._images = None
+
+        if source == "pattern":
+            width, height = size
+            # Static colour bars; the moving box and counter are drawn per frame
+            bars = np.array([[255, 255, 255], [0, 255, 255], [255, 255, 0], [0, 255, 0],
+                             [255, 0, 255], [0, 0, 255], [255, 0, 0], [0, 0, 0]], dtype=np.uint8)
+            self._background = np.ascontiguousarray(
+                np.broadcast_to(np.repeat(bars, -(-width // len(bars)), axis=0)[:width], (height, width, 3))
             )
-            _picam2_instance.configure(config)
-            _picam2_instance.start()
-            time.sleep(2) # Allow camera to warm up
-            print("INFO: Picamera2 camera initialized and started.")
-        except ImportError:
-            # CORRECTED DIAGNOSTIC MESSAGE HERE
-            print("ERROR: Picamera2 library not found. Ensure it's installed via 'uv sync --extra pi'.")
-            raise
-        except Exception as e:
-            print(f"ERROR: Failed to initialize Picamera2: {e}")
-            _picam2_instance = None
-            raise
-
-    _camera_initialized = True
-
-# ... (rest of camera.py remains the same) ...
-
-def get_frame():
-    if not _camera_initialized:
-        # This should ideally not happen if initialize_camera is called first
-        print("WARN: get_frame called before camera initialization. Attempting to initialize.")
-        try:
-            initialize_camera()
-        except RuntimeError as e:
-            print(f"ERROR: Camera could not be initialized in get_frame: {e}")
-            return None
+        elif os.path.isdir(source):
+            paths = sorted(
+                os.path.join(source, name) for name in os.listdir(source)
+                if name.lower().endswith(self.IMAGE_EXTENSIONS)
+            )
+            self._images = [cv2.resize(cv2.imread(path), size) for path in paths]
+            if not self._images:
+                raise RuntimeError(f"No images found in synthetic source directory {source}.")
+        else:
+            self._video = cv2.VideoCapture(source)
+            if not self._video.isOpened():
+                raise RuntimeError(f"Could not open synthetic source video {source}.")
 
+    def read(self):
+        # Behave like a real camera: block until the next frame is due
+        delay = self._next_frame - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame = max(self._next_frame + self._interval, time.monotonic())
 
-    if USE_OPENCV_ENV:
-        if _opencv_cap is None or not _opencv_cap.isOpened():
-            print("ERROR: OpenCV camera is not open.")
-            return None
-        ret, frame = _opencv_cap.read()
-        if not ret or frame is None:
-            print("WARN: Failed to capture frame from OpenCV.")
-            return None
-    else:
-        if _picam2_instance is None:
-            print("ERROR: Picamera2 instance is not available.")
-            return None
-        frame = _picam2_instance.capture_array("main") # Capture from the 'main' stream
+        index = self._index
+        self._index += 1
+        if self._images is not None:
+            return self._images[index % len(self._images)]
+        if self._video is not None:
+            ret, frame = self._video.read()
+            if not ret:
+                self._video.set(cv2.CAP_PROP_POS_FRAMES, 0) # Loop the video
+                ret, frame = self._video.read()
+            return cv2.resize(frame, self.size) if ret else None
+
+        frame = self._background.copy()
+        width, height = self.size
+        # Large, fast moving grey box so every frame registers as motion
+        box = max(8, height // 3)
+        x = (index * 16) % (width - box)
+        y = (height - box) // 2
+        frame[y:y + box, x:x + box] = 128
+        cv2.putText(frame, f"#{index}", (10, height - 20), cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 0, 0), 2)
+        return frame
+
+    def release(self):
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+def _read_cached_index():
+    try:
+        with open(CAMERA_INDEX_CACHE_ENV) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def _write_cached_index(index):
+    try:
+        os.makedirs(os.path.dirname(CAMERA_INDEX_CACHE_ENV), exist_ok=True)
+        with open(CAMERA_INDEX_CACHE_ENV, "w") as f:
+            f.write(str(index))
+    except OSError as e:
+        print(f"WARN: Could not cache camera index: {e}")
+
+def _probe_opencv_index(index):
+    cap = cv2.VideoCapture(index)
+    if cap.isOpened():
+        return cap
+    cap.release()
+    return None
+
+def _open_opencv_camera():
+    # The cached index usually opens straight away; otherwise probe all indices at once
+    cached = _read_cached_index()
+    if cached is not None:
+        cap = _probe_opencv_index(cached)
+        if cap is not None:
+            print(f"INFO: Opened cached OpenCV camera index {cached}.")
+            return cap
+
+    with ThreadPoolExecutor(max_workers=OPENCV_MAX_INDEX) as pool:
+        caps = list(pool.map(_probe_opencv_index, range(OPENCV_MAX_INDEX)))
+    opened = [index for index, cap in enumerate(caps) if cap is not None]
+    if not opened:
+        return None
+    chosen = opened[0] # Prefer the lowest index, like the default camera
+    for index in opened[1:]:
+        caps[index].release()
+    print(f"INFO: Probed OpenCV camera indices {opened}, using {chosen}.")
+    _write_cached_index(chosen)
+    return caps[chosen]
+
+class Camera:
+    """
+    One named camera source. Owns its device handle, so several sources (e.g. a wrist
+    and an overview camera) can be captured side by side, each from its own thread.
+
+    kind is "picamera", "opencv" or "synthetic"; device is the Picamera2 camera number,
+    the OpenCV index or path (probed when None), or the synthetic source spec.
+    """
+
+    KINDS = ("picamera", "opencv", "synthetic")
+
+    def __init__(self, name="default", kind="picamera", device=None, size=FRAME_SIZE):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown camera kind '{kind}' for source '{name}'")
+        self.name = name
+        self.kind = kind
+        self.device = device
+        self.size = size
+        self._initialized = False
+        self._opencv_cap = None
+        self._picam2 = None
+        self._synthetic = None
+
+    def __repr__(self):
+        device = "" if self.device is None else f":{self.device}"
+        return f"Camera({self.name}={self.kind}{device})"
+
+    @property
+    def initialized(self):
+        return self._initialized
+
+    def _wait_for_first_picamera_frame(self):
+        # Replaces a fixed warm-up sleep: return as soon as the sensor delivers real image data
+        started = time.monotonic()
+        while time.monotonic() - started < PICAMERA_WARMUP_TIMEOUT:
+            frame = self._picam2.capture_array("main")
+            if frame is not None and frame.any():
+                break
+        return time.monotonic() - started
+
+    def initialize(self):
+        if self._initialized:
+            return
+
+        if self.kind == "synthetic":
+            source = self.device or SYNTHETIC_SOURCE_ENV
+            print(f"INFO: [{self.name}] Initializing synthetic camera source '{source}'...")
+            self._synthetic = SyntheticSource(source, self.size, SYNTHETIC_FPS_ENV)
+            print(f"INFO: [{self.name}] Synthetic camera source initialized.")
+        elif self.kind == "opencv":
+            print(f"INFO: [{self.name}] Initializing OpenCV camera (local development mode)...")
+            if self.device is None:
+                self._opencv_cap = _open_opencv_camera()
+            else:
+                self._opencv_cap = _probe_opencv_index(int(self.device) if str(self.device).isdigit() else self.device)
+            if self._opencv_cap is None:
+                raise RuntimeError(f"Could not open OpenCV video stream for source '{self.name}'.")
+            self._opencv_cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.size[0])
+            self._opencv_cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.size[1])
+            print(f"INFO: [{self.name}] OpenCV camera initialized using {self._opencv_cap.getBackendName()}.")
+        else:
+            print(f"INFO: [{self.name}] Initializing Picamera2 (Raspberry Pi mode)...")
+            try:
+                from picamera2 import Picamera2
+                self._picam2 = Picamera2() if self.device is None else Picamera2(int(self.device))
+                config = self._picam2.create_preview_configuration(
+                    main={"size": self.size, "format": "RGB888"},
+                    controls={"FrameRate": 30}
+                )
+                self._picam2.configure(config)
+                self._picam2.start()
+                warmup = self._wait_for_first_picamera_frame()
+                print(f"INFO: [{self.name}] Picamera2 camera initialized and started, first frame after {warmup:.2f}s.")
+            except ImportError:
+                # CORRECTED DIAGNOSTIC MESSAGE HERE
+                print("ERROR: Picamera2 library not found. Ensure it's installed via 'uv sync --extra pi'.")
+                raise
+            except Exception as e:
+                print(f"ERROR: [{self.name}] Failed to initialize Picamera2: {e}")
+                self._picam2 = None
+                raise
+
+        self._initialized = True
+
+    def capture(self):
+        if not self._initialized:
+            # This should ideally not happen if initialize is called first
+            print(f"WARN: [{self.name}] capture called before camera initialization. Attempting to initialize.")
+            try:
+                self.initialize()
+            except RuntimeError as e:
+                print(f"ERROR: [{self.name}] Camera could not be initialized in capture: {e}")
+                return None
+
+        started = time.perf_counter()
+        if self.kind == "synthetic":
+            frame = self._synthetic.read() if self._synthetic is not None else None
+        elif self.kind == "opencv":
+            if self._opencv_cap is None or not self._opencv_cap.isOpened():
+                print(f"ERROR: [{self.name}] OpenCV camera is not open.")
+                metrics.capture_failures.inc(self.name)
+                return None
+            ret, frame = self._opencv_cap.read()
+            frame = frame if ret else None
+        else:
+            frame = self._picam2.capture_array("main") if self._picam2 is not None else None # 'main' stream
         if frame is None:
-            print("WARN: Failed to capture frame from Picamera2.")
+            print(f"WARN: [{self.name}] Failed to capture frame from {self.kind} camera.")
+            metrics.capture_failures.inc(self.name)
             return None
+        metrics.capture_seconds.observe(time.perf_counter() - started, self.name)
+
+        return frame
 
-    # Encode frame to JPEG
-    ret, buffer = cv2.imencode(".jpg", frame)
+    def cleanup(self):
+        print(f"INFO: [{self.name}] Cleaning up camera resources...")
+        if self._synthetic is not None:
+            self._synthetic.release()
+            print(f"INFO: [{self.name}] Synthetic camera source released.")
+        if self._opencv_cap is not None and self._opencv_cap.isOpened():
+            self._opencv_cap.release()
+            print(f"INFO: [{self.name}] OpenCV camera released.")
+        if self._picam2 is not None:
+            try:
+                self._picam2.stop()
+                print(f"INFO: [{self.name}] Picamera2 camera stopped.")
+            except Exception as e:
+                print(f"WARN: [{self.name}] Error stopping Picamera2: {e}")
+        self._initialized = False
+        self._opencv_cap = None
+        self._picam2 = None
+        self._synthetic = None
+
+def parse_camera_sources(spec):
+    """
+    Parses a CAMERA_SOURCES value such as "wrist=opencv:0,overview=picamera:1" into
+    Camera objects, in order. Raises ValueError for malformed entries.
+    """
+    cameras = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        name, sep, target = entry.partition("=")
+        name = name.strip()
+        if not sep or not name or not all(c.isalnum() or c in "-_" for c in name):
+            raise ValueError(f"Invalid camera source '{entry}', expected name=kind[:device]")
+        if any(camera.name == name for camera in cameras):
+            raise ValueError(f"Duplicate camera source name '{name}'")
+        kind, _, device = target.strip().partition(":")
+        cameras.append(Camera(name, kind, device or None))
+    if not cameras:
+        raise ValueError("CAMERA_SOURCES does not name any camera")
+    return cameras
+
+def create_cameras():
+    """Returns the configured camera sources; the first one is the default /video source."""
+    if CAMERA_SOURCES_ENV:
+        return parse_camera_sources(CAMERA_SOURCES_ENV)
+    kind = "synthetic" if USE_SYNTHETIC_ENV else "opencv" if USE_OPENCV_ENV else "picamera"
+    return [Camera("default", kind)]
+
+def resize_frame(frame, width):
+    # Downscale to the requested width, keeping the aspect ratio
+    height, current_width = frame.shape[:2]
+    if width is None or width >= current_width:
+        return frame
+    new_height = max(1, round(height * width / current_width))
+    return cv2.resize(frame, (width, new_height), interpolation=cv2.INTER_AREA)
+
+def encode_frame(frame, quality=None):
+    # Encode frame to JPEG, using OpenCV's default quality unless one is given
+    params = [] if quality is None else [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    ret, buffer = cv2.imencode(".jpg", frame, params)
     if not ret:
         print("WARN: Failed to encode frame to JPEG.")
         return None
     return buffer.tobytes()
 
-def cleanup_camera():
-    global _camera_initialized, _opencv_cap, _picam2_instance
-    print("INFO: Cleaning up camera resources...")
-    if USE_OPENCV_ENV:
-        if _opencv_cap and _opencv_cap.isOpened():
-            _opencv_cap.release()
-            print("INFO: OpenCV camera released.")
-    else:
-        if _picam2_instance:
-            try:
-                _picam2_instance.stop()
-                print("INFO: Picamera2 camera stopped.")
-            except Exception as e:
-                print(f"WARN: Error stopping Picamera2: {e}")
-    _camera_initialized = False
-    _opencv_cap = None
-    _picam2_instance = None
+class ChangeDetector:
+    """
+    Decides whether a frame differs enough from the last accepted one to be worth
+    encoding. Works on a small grayscale copy, so the check costs a fraction of a
+    JPEG encode.
+    """
+
+    def __init__(self, threshold=CHANGE_THRESHOLD_ENV, pixel_delta=12, size=(80, 60)):
+        self.threshold = threshold      # Fraction of pixels that must change
+        self.pixel_delta = pixel_delta  # Gray level difference counted as a change (filters sensor noise)
+        self.size = size
+        self._reference = None
+
+    def _downscale(self, frame):
+        small = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small.astype(np.int16)
+
+    def has_changed(self, frame):
+        small = self._downscale(frame)
+        reference = self._reference  # reset() may be called from the encode publisher thread
+        if reference is None or reference.shape != small.shape:
+            self._reference = small
+            return True
+        changed = np.count_nonzero(np.abs(small - reference) > self.pixel_delta)
+        if changed > self.threshold * small.size:
+            self._reference = small
+            return True
+        return False
+
+    def reset(self):
+        self._reference = None
 
-import atexit
-atexit.register(cleanup_camera)
+def create_change_detector():
+    return ChangeDetector() if CHANGE_DETECTION_ENV else None
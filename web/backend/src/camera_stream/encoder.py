@@ -0,0 +1,170 @@
+# backend/src/camera_stream/encoder.py
+import collections
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+from . import metrics
+
+
+class EncoderPool:
+    """
+    Spreads JPEG encoding over several worker threads (cv2.imencode releases the
+    GIL, so they run on separate cores) and hands the results back in capture
+    order. Frames whose encode falls more than max_lag captures behind the newest
+    one are dropped instead of being published late.
+    """
+
+    def __init__(self, encode, workers, max_lag=None, source="default"):
+        self._encode = encode
+        self.source = source
+        self.workers = workers
+        self.max_lag = max_lag if max_lag is not None else 2 * workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="jpeg-encode")
+        self._cond = threading.Condition()
+        self._pending = collections.deque()  # (index, timestamp, image, future), capture order
+        self._newest_index = 0
+        self._closed = False
+
+    def _timed_encode(self, image):
+        started = time.perf_counter()
+        jpeg = self._encode(image)
+        return jpeg, time.perf_counter() - started
+
+    def submit(self, timestamp, image):
+        """Queues a captured frame for encoding, dropping queued frames that are now too old."""
+        with self._cond:
+            if self._closed:
+                return
+            self._newest_index += 1
+            self._drop_stale()
+            future = self._executor.submit(self._timed_encode, image)
+            self._pending.append((self._newest_index, timestamp, image, future))
+            self._cond.notify_all()
+
+    def next_encoded(self, timeout=None):
+        """
+        Returns (timestamp, image, jpeg, encode_time) for the oldest frame that is still
+        current, waiting for its encode to finish. jpeg is None if the encode failed, so the
+        caller knows the frame will not be published. Returns None on timeout or close.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._pending, timeout=timeout)
+                self._drop_stale()
+                if self._closed or not self._pending:
+                    return None
+                index, timestamp, image, future = self._pending[0]
+
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                jpeg, encode_time = future.result(timeout=remaining)
+            except TimeoutError:
+                return None
+            except CancelledError:
+                continue # Dropped as stale while we were waiting
+            except Exception as e:
+                print(f"ERROR: [{self.source}] JPEG encode failed: {e}")
+                jpeg, encode_time = None, 0.0
+
+            with self._cond:
+                if not self._pending or self._pending[0][0] != index:
+                    continue # Dropped as stale while it was being encoded
+                self._pending.popleft()
+                stale = self._newest_index - index > self.max_lag
+            if stale:
+                metrics.encode_dropped.inc(self.source)
+                continue
+            return timestamp, image, jpeg, encode_time
+
+    def _drop_stale(self):
+        # Caller holds self._cond
+        while self._pending and self._newest_index - self._pending[0][0] > self.max_lag:
+            self._pending.popleft()[3].cancel()
+            metrics.encode_dropped.inc(self.source)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            for *_, future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
+
+
+class EncodeScheduler:
+    """
+    Shares a total JPEG encode budget, in CPU seconds of encoding per second, between
+    camera sources. Every registered source earns an equal share. Budget a source
+    leaves unused overflows into a common pool that busier sources may draw on, so a
+    high-fps source can use idle capacity but never starve the others.
+    """
+
+    BURST_SECONDS = 0.5  # How much unused budget a source, and the pool, may save up
+
+    def __init__(self, budget):
+        self.budget = budget  # 0 or less disables the limit
+        self._lock = threading.Lock()
+        self._balances = {}  # source -> encode seconds it may still spend
+        self._pool = 0.0
+        self._updated = time.monotonic()
+
+    def register(self, source):
+        with self._lock:
+            self._refill()
+            self._balances.setdefault(source, 0.0)
+            # Start with a full burst so a new source's first frames go out at once
+            self._balances[source] = self._cap()
+
+    def unregister(self, source):
+        with self._lock:
+            self._refill()
+            self._balances.pop(source, None)
+
+    def _cap(self):
+        # Caller holds self._lock
+        return self.budget / max(1, len(self._balances)) * self.BURST_SECONDS
+
+    def _refill(self):
+        # Caller holds self._lock
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        if not self._balances or self.budget <= 0:
+            return
+        share = self.budget / len(self._balances)
+        cap = self._cap()
+        for source, balance in self._balances.items():
+            balance += share * elapsed
+            if balance > cap:
+                self._pool += balance - cap
+                balance = cap
+            self._balances[source] = balance
+        self._pool = min(self._pool, self.budget * self.BURST_SECONDS)
+
+    def may_encode(self, source):
+        """True if source has budget left for another encode, from its own share or the pool."""
+        if self.budget <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            return self._balances.get(source, 0.0) > 0 or self._pool > 0
+
+    def charge(self, source, seconds):
+        """Books the duration of an encode against source's share, borrowing from the pool when it is used up."""
+        if self.budget <= 0:
+            return
+        with self._lock:
+            self._refill()
+            balance = self._balances.get(source)
+            if balance is None:
+                return
+            own = min(seconds, max(balance, 0.0))
+            borrowed = seconds - own
+            if borrowed > 0 and self._pool > 0:
+                self._pool -= borrowed
+            else:
+                own = seconds
+            self._balances[source] = balance - own
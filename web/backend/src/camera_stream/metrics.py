@@ -0,0 +1,137 @@
+# backend/src/camera_stream/metrics.py
+# Minimal Prometheus-style metrics. Updating a metric costs a lock and a dict
+# lookup, which is cheap enough to keep enabled on the Pi's hot paths.
+import bisect
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = []
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def remove(self, *labelvalues):
+        """Drops the series for the given label values, e.g. once a client has disconnected."""
+        with self._lock:
+            self._values.pop(labelvalues, None)
+
+    def _label_string(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def _samples(self):
+        with self._lock:
+            return [(labels, value) for labels, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labelvalues, value in self._samples():
+            lines.append(f"{self.name}{self._label_string(labelvalues)} {value}")
+        return lines
+
+
+class _Value(_Metric):
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Counter(_Value):
+    type_name = "counter"
+
+
+class Gauge(_Value):
+    type_name = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    # Seconds; covers a sub-millisecond encode up to a stalled capture
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, plus the +Inf bucket, sum and count
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            return [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for labelvalues, (counts, total, count) in self._samples():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{self._label_string(labelvalues, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_string(labelvalues)} {total}")
+            lines.append(f"{self.name}_count{self._label_string(labelvalues)} {count}")
+        return lines
+
+
+def render():
+    """Returns all registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Camera hot paths, per camera source
+capture_seconds = Histogram("camera_capture_seconds", "Time spent in capture_array/read per frame.", ["source"])
+encode_seconds = Histogram("camera_encode_seconds", "Time spent in cv2.imencode per frame.", ["source"])
+encode_dropped = Counter("camera_encode_dropped_total", "Frames dropped because their encode fell too far behind the newest capture.", ["source"])
+encode_throttled = Counter("camera_encode_throttled_total", "Frames not encoded because the source used up its share of the encode budget.", ["source"])
+capture_failures = Counter("camera_capture_failures_total", "Captures that returned no frame.", ["source"])
+unchanged_frames = Counter("camera_unchanged_frames_total", "Frames skipped by change detection instead of being encoded.", ["source"])
+
+time_to_first_frame = Gauge("camera_time_to_first_frame_seconds", "Time from broadcaster start (incl. camera initialization) to the first published frame.", ["source"])
+
+# Streaming
+active_streams = Gauge("stream_active_clients", "Number of connected /video clients.")
+frames_sent = Counter("stream_frames_sent_total", "Frames sent to a /video client.", ["client"])
+frames_dropped = Counter("stream_frames_dropped_total", "Frames a /video client missed because it fell behind.", ["client"])
+
+# Vision stage
+vision_frames = Counter("vision_frames_total", "Frames analysed by the vision stage.", ["source"])
+vision_skipped = Counter("vision_frames_skipped_total", "Published frames the vision stage skipped because it was busy or rate limited.", ["source"])
+vision_processing_seconds = Histogram("vision_processing_seconds", "Time spent downscaling and detecting per analysed frame.", ["source"])
+vision_latency_seconds = Histogram("vision_latency_seconds", "Time from frame capture until its targets were detected or published to MQTT.", ["source", "stage"])
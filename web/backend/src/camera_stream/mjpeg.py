@@ -0,0 +1,97 @@
+# backend/src/camera_stream/mjpeg.py
+# Helpers shared by the Flask and the asyncio server for the MJPEG and WebSocket streams.
+import math
+import struct
+
+MIMETYPE = "multipart/x-mixed-replace; boundary=frame"
+
+INDEX_HTML = """
+    <!DOCTYPE html><html><head><title>Pi Camera Stream</title></head>
+    <body><h1>Pi Camera Stream Backend</h1>
+    <p>MJPEG stream available at <a href="/video">/video</a>.</p>
+    <p>Latest still image available at <a href="/snapshot">/snapshot</a>.</p>
+    {sources}
+    <img src="/video" width="640" height="480" alt="Live Stream" />
+    </body></html>
+    """
+
+def index_html(source_names):
+    # Lists the per-source endpoints when more than one camera is configured
+    if len(source_names) < 2:
+        return INDEX_HTML.format(sources="")
+    links = "".join(
+        f'<li>{name}: <a href="/video/{name}">/video/{name}</a>, <a href="/snapshot/{name}">/snapshot/{name}</a></li>'
+        for name in source_names
+    )
+    return INDEX_HTML.format(sources=f"<p>Camera sources:</p><ul>{links}</ul>")
+
+def encode_part(frame, jpeg=None):
+    # Extra part headers are ignored by browsers but let tools such as the
+    # benchmark measure latency without decoding anything.
+    jpeg = frame.jpeg if jpeg is None else jpeg
+    headers = (
+        "--frame\r\n"
+        "Content-Type: image/jpeg\r\n"
+        f"Content-Length: {len(jpeg)}\r\n"
+        f"X-Frame-Seq: {frame.seq}\r\n"
+        f"X-Timestamp: {frame.timestamp:.6f}\r\n"
+        f"X-Encode-Ms: {frame.encode_time * 1000:.3f}\r\n\r\n"
+    )
+    return headers.encode("ascii") + jpeg + b"\r\n\r\n"
+
+# Header of every WebSocket frame message, followed by the JPEG bytes (little-endian):
+# version (u8), 3 padding bytes, encode duration in microseconds (u32),
+# sequence number (u64), capture timestamp in seconds since the epoch (f64).
+WS_FRAME_HEADER = struct.Struct("<B3xIQd")
+WS_FRAME_VERSION = 1
+
+def encode_ws_header(frame):
+    encode_us = min(int(frame.encode_time * 1e6), 0xFFFFFFFF)
+    return WS_FRAME_HEADER.pack(WS_FRAME_VERSION, encode_us, frame.seq, frame.timestamp)
+
+def variant_etag(frame, options):
+    # ETag of the frame as served with the given width/quality options
+    if options.width is None and options.quality is None:
+        return frame.etag
+    return f"{frame.etag}-w{options.width or 0}-q{options.quality or 0}"
+
+class StreamOptions:
+    """Per-client stream settings taken from the query string, e.g. ?fps=10&width=320&quality=60."""
+
+    MAX_FPS = 60
+    MIN_WIDTH = 16
+
+    def __init__(self, fps=None, width=None, quality=None):
+        self.fps = fps
+        self.width = width
+        self.quality = quality
+
+    @property
+    def interval(self):
+        # Minimum time between two frames sent to this client
+        return 1.0 / self.fps if self.fps else 0.0
+
+    @classmethod
+    def from_args(cls, args):
+        """Parses a request's query arguments. Raises ValueError for invalid values."""
+        fps = parse_query_arg(args, "fps", float, 0, cls.MAX_FPS)
+        width = parse_query_arg(args, "width", int, cls.MIN_WIDTH, None)
+        quality = parse_query_arg(args, "quality", int, 1, 100)
+        return cls(fps=fps, width=width, quality=quality)
+
+
+def parse_query_arg(args, name, type_, minimum, maximum):
+    # Returns None when the argument is missing, raises ValueError when it is invalid
+    raw = args.get(name)
+    if raw is None or raw == "":
+        return None
+    try:
+        value = type_(raw)
+    except ValueError:
+        raise ValueError(f"Invalid value for '{name}': {raw}")
+    # nan would pass every comparison below
+    if not math.isfinite(value):
+        raise ValueError(f"Invalid value for '{name}': {raw}")
+    if value <= 0 or value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"Value for '{name}' out of range: {raw}")
+    return value
@@ -0,0 +1,173 @@
+# backend/src/camera_stream/replay.py
+# Keeps the last few seconds of encoded frames in memory so a failed arm move
+# can be replayed, and dumps them to compact segment files.
+#
+# Segment file layout: an 8 byte magic, then one record per frame made of a
+# little-endian header (capture timestamp as double, sequence number, JPEG
+# length) followed by the JPEG bytes.
+import collections
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+REPLAY_SECONDS_ENV = float(os.environ.get("REPLAY_SECONDS", "30"))
+REPLAY_MAX_MB_ENV = float(os.environ.get("REPLAY_MAX_MB", "32"))
+REPLAY_DIR_ENV = os.environ.get("REPLAY_DIR", os.path.join(tempfile.gettempdir(), "camera_stream_replays"))
+
+SEGMENT_MAGIC = b"CSSEG001"
+RECORD_HEADER = struct.Struct("<dQI")
+
+
+@dataclass(frozen=True)
+class ReplayFrame:
+    seq: int
+    timestamp: float
+    jpeg: bytes
+    encode_time: float = 0.0
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of the most recent encoded frames, bounded by age and total size.
+    Only the JPEG bytes are kept, never the raw images.
+    """
+
+    def __init__(self, seconds=REPLAY_SECONDS_ENV, max_bytes=int(REPLAY_MAX_MB_ENV * 1024 * 1024)):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self._frames = collections.deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, frame):
+        """Adds a published frame; meant to be registered as a broadcaster listener."""
+        entry = ReplayFrame(frame.seq, frame.timestamp, frame.jpeg, frame.encode_time)
+        with self._lock:
+            previous = self._frames[-1] if self._frames else None
+            self._frames.append(entry)
+            # Republished static frames share their bytes with the previous entry
+            if previous is None or previous.jpeg is not entry.jpeg:
+                self._bytes += len(entry.jpeg)
+            oldest_allowed = entry.timestamp - self.seconds
+            while self._frames and (self._frames[0].timestamp < oldest_allowed or self._bytes > self.max_bytes):
+                dropped = self._frames.popleft()
+                if not self._frames or self._frames[0].jpeg is not dropped.jpeg:
+                    self._bytes -= len(dropped.jpeg)
+
+    def frames(self, seconds=None):
+        """Returns the buffered frames of the last `seconds` (all if None), oldest first."""
+        with self._lock:
+            snapshot = tuple(self._frames)
+        if seconds is None or not snapshot:
+            return snapshot
+        since = snapshot[-1].timestamp - seconds
+        start = next((i for i, entry in enumerate(snapshot) if entry.timestamp >= since), len(snapshot))
+        return snapshot[start:]
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def export(self, path=None, seconds=None):
+        """
+        Writes the buffered frames to a segment file and returns (path, frame count, bytes written).
+        The lock is only held to take a snapshot, so the live stream keeps running.
+        """
+        frames = self.frames(seconds)
+        if path is None:
+            os.makedirs(REPLAY_DIR_ENV, exist_ok=True)
+            # Nanoseconds in the name, so exports within the same second do not overwrite each other
+            stamp = time.time_ns()
+            name = time.strftime("replay-%Y%m%d-%H%M%S", time.localtime(stamp // 1_000_000_000))
+            path = os.path.join(REPLAY_DIR_ENV, f"{name}-{stamp % 1_000_000_000:09d}.seg")
+        written = write_segment(path, frames)
+        return path, len(frames), written
+
+
+def replay_delays(frames):
+    # Pairs every frame with the time to wait before sending it, to replay at the
+    # original pace (gaps are capped, e.g. while change detection held a static frame)
+    previous = None
+    for entry in frames:
+        delay = 0.0 if previous is None else min(max(entry.timestamp - previous, 0.0), 1.0)
+        previous = entry.timestamp
+        yield delay, entry
+
+
+def write_segment(path, frames):
+    # Unbuffered writes straight from the frame bytes; nothing is concatenated in memory
+    written = 0
+    with open(path, "wb", buffering=0) as f:
+        written += _write_all(f.fileno(), (SEGMENT_MAGIC,))
+        for entry in frames:
+            header = RECORD_HEADER.pack(entry.timestamp, entry.seq, len(entry.jpeg))
+            written += _write_all(f.fileno(), (header, entry.jpeg))
+    return written
+
+
+def _write_all(fd, buffers):
+    # writev() and write() may write fewer bytes than asked; continue from where they
+    # stopped, as a partial record would corrupt the layout of everything after it
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    total = sum(len(view) for view in views)
+    while views:
+        count = os.writev(fd, views) if hasattr(os, "writev") else os.write(fd, views[0])
+        if count == 0:
+            raise OSError(f"No progress writing to file descriptor {fd}")
+        while views and count >= len(views[0]):
+            count -= len(views.pop(0))
+        if count:
+            views[0] = views[0][count:]
+    return total
+
+
+def read_segment(path):
+    """
+    Yields (seq, timestamp, jpeg) for every frame in a segment file. The file is
+    memory-mapped and jpeg is a memoryview into it, so reading copies nothing;
+    the view is only valid until the next frame is requested.
+    """
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC:
+                raise ValueError(f"{path} is not a replay segment file")
+            view = memoryview(mapped)
+            try:
+                offset = len(SEGMENT_MAGIC)
+                while offset + RECORD_HEADER.size <= len(mapped):
+                    timestamp, seq, length = RECORD_HEADER.unpack_from(mapped, offset)
+                    offset += RECORD_HEADER.size
+                    jpeg = view[offset:offset + length]
+                    try:
+                        yield seq, timestamp, jpeg
+                    finally:
+                        jpeg.release()
+                    offset += length
+            finally:
+                view.release()
+
+
+def main(argv=None):
+    # Extracts a segment into numbered JPEG files: python -m camera_stream.replay <segment> <directory>
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("Usage: python -m camera_stream.replay <segment-file> <output-directory>")
+        return 1
+    segment, output_dir = argv
+    os.makedirs(output_dir, exist_ok=True)
+    count = 0
+    for seq, timestamp, jpeg in read_segment(segment):
+        with open(os.path.join(output_dir, f"{count:05d}-{seq}-{timestamp:.3f}.jpg"), "wb") as f:
+            f.write(jpeg)
+        count += 1
+    print(f"INFO: Extracted {count} frames to {output_dir}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
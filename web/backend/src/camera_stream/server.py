@@ -1,67 +1,150 @@
 # backend/src/pi_camera_app/server.py
-from flask import Flask, Response
+from flask import Flask, Response, abort, jsonify, request
 from flask_cors import CORS
-from .camera import initialize_camera, get_frame # Relative import
-import time
+from . import metrics # Relative import
+from .broadcaster import create_broadcasters
+from .mjpeg import MIMETYPE, StreamOptions, index_html, encode_part, parse_query_arg, variant_etag
+from .replay import ReplayBuffer, replay_delays
+from .vision import create_vision_stage
+import atexit
 import os
+import time
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})  # Allow requests from any origin
 
-# Initialize camera once when the app starts, if not already done by a direct call
-# This helps if generate_frames is called by multiple workers/threads
-_initial_camera_init_attempted = False
-def ensure_camera_initialized():
-    global _initial_camera_init_attempted
-    if not _initial_camera_init_attempted:
-        try:
-            print("INFO: Server attempting one-time camera initialization...")
-            initialize_camera()
-        except Exception as e:
-            print(f"ERROR: Initial camera setup in server failed: {e}")
-            # Decide if the app should run without a camera or exit
-        finally:
-            _initial_camera_init_attempted = True
+# One background thread per camera source initializes the camera, then captures
+# and encodes frames; every client streams whatever it has published last instead
+# of encoding on its own. The server does not wait for the cameras to come up.
+broadcasters = create_broadcasters()
+default_source = next(iter(broadcasters))
+# Last few seconds of encoded frames per source, for /replay
+replay_buffers = {}
+for source_name, source_broadcaster in broadcasters.items():
+    replay_buffers[source_name] = ReplayBuffer()
+    source_broadcaster.add_listener(replay_buffers[source_name].append)
+# Spawned worker processes (the vision stage) re-run this module as __mp_main__;
+# only the server process itself opens the cameras
+if __name__ != "__mp_main__":
+    for source_broadcaster in broadcasters.values():
+        source_broadcaster.start()
+        atexit.register(source_broadcaster.stop)
+    # Optional object/marker tracking in a separate process (VISION_DETECTOR)
+    vision_stage = create_vision_stage(broadcasters)
+    if vision_stage is not None:
+        vision_stage.start()
+        atexit.register(vision_stage.stop)
+
+def resolve_source(name):
+    # None selects the default source (the first configured one)
+    name = name or default_source
+    if name not in broadcasters:
+        abort(Response(f"Unknown camera source '{name}'", status=404, mimetype="text/plain"))
+    return name
+
+def generate_frames(broadcaster, options=None, client="unknown"):
+    options = options or StreamOptions()
+    metrics.active_streams.inc()
+    try:
+        last_seq = 0
+        next_send = 0.0
+        while broadcaster.running:
+            # Pace clients that asked for a lower frame rate; they always get the newest frame
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            frame = broadcaster.wait_for_frame(last_seq, timeout=1.0)
+            if frame is None:
+                continue
+            if last_seq and not options.fps and frame.seq > last_seq + 1:
+                metrics.frames_dropped.inc(client, amount=frame.seq - last_seq - 1)
+            last_seq = frame.seq
+            next_send = max(next_send + options.interval, time.monotonic())
+            yield encode_part(frame, broadcaster.get_variant(frame, options.width, options.quality))
+            metrics.frames_sent.inc(client)
+    finally:
+        metrics.active_streams.dec()
+        metrics.frames_sent.remove(client)
+        metrics.frames_dropped.remove(client)
+
+@app.route("/video", defaults={"name": None})
+@app.route("/video/<name>")
+def video_feed_route(name):
+    broadcaster = broadcasters[resolve_source(name)]
+    try:
+        options = StreamOptions.from_args(request.args)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
+    client = f"{request.remote_addr}:{request.environ.get('REMOTE_PORT', '')}"
+    return Response(generate_frames(broadcaster, options, client), mimetype=MIMETYPE)
+
+@app.route("/snapshot", defaults={"name": None})
+@app.route("/snapshot/<name>")
+def snapshot_route(name):
+    # Served from the latest published frame, never triggers a capture or encode of its own
+    broadcaster = broadcasters[resolve_source(name)]
+    try:
+        options = StreamOptions.from_args(request.args)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
+    frame = broadcaster.latest()
+    if frame is None:
+        return Response("No frame available yet", status=503, mimetype="text/plain", headers={"Retry-After": "1"})
+
+    etag = variant_etag(frame, options)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(broadcaster.get_variant(frame, options.width, options.quality), mimetype="image/jpeg")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+def generate_replay(frames):
+    for delay, entry in replay_delays(frames):
+        if delay > 0:
+            time.sleep(delay)
+        yield encode_part(entry)
 
-ensure_camera_initialized() # Attempt to initialize camera at startup
+@app.route("/replay", defaults={"name": None})
+@app.route("/replay/<name>")
+def replay_route(name):
+    replay_buffer = replay_buffers[resolve_source(name)]
+    try:
+        seconds = parse_query_arg(request.args, "seconds", float, 0, replay_buffer.seconds)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
+    return Response(generate_replay(replay_buffer.frames(seconds)), mimetype=MIMETYPE)
 
-def generate_frames():
-    # Ensure camera is ready before streaming
-    if not _initial_camera_init_attempted : # Or check a more robust camera status flag
-        print("WARN: Camera not initialized at generate_frames start. Retrying init.")
-        ensure_camera_initialized()
+@app.route("/replay/export", methods=["POST"], defaults={"name": None})
+@app.route("/replay/<name>/export", methods=["POST"])
+def replay_export_route(name):
+    replay_buffer = replay_buffers[resolve_source(name)]
+    try:
+        seconds = parse_query_arg(request.args, "seconds", float, 0, replay_buffer.seconds)
+    except ValueError as e:
+        return Response(str(e), status=400, mimetype="text/plain")
+    path, frame_count, size = replay_buffer.export(seconds=seconds)
+    print(f"INFO: Exported {frame_count} replay frames to {path}.")
+    return jsonify(path=path, frames=frame_count, bytes=size)
 
-    while True:
-        try:
-            frame_bytes = get_frame()
-            if frame_bytes:
-                yield (
-                    b"--frame\r\n"
-                    b"Content-Type: image/jpeg\r\n\r\n" + frame_bytes + b"\r\n\r\n"
-                )
-            else:
-                # If get_frame returns None (e.g., error), wait a bit
-                # print("WARN: No frame received from camera. Waiting...")
-                time.sleep(0.1) # Short delay before retrying
-        except Exception as e:
-            print(f"ERROR in generate_frames loop: {e}")
-            time.sleep(1) # Longer delay if there's an exception
+@app.route("/health")
+def health_route():
+    # 200 once every camera delivers frames, 503 while any of them is still starting
+    ready = all(broadcaster.ready for broadcaster in broadcasters.values())
+    sources = {
+        name: {"ready": broadcaster.ready, "time_to_first_frame": broadcaster.time_to_first_frame}
+        for name, broadcaster in broadcasters.items()
+    }
+    return jsonify(ready=ready, sources=sources), 200 if ready else 503
 
-@app.route("/video")
-def video_feed_route():
-    return Response(
-        generate_frames(), mimetype="multipart/x-mixed-replace; boundary=frame"
-    )
+@app.route("/metrics")
+def metrics_route():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route("/")
 def index_route():
-    return """
-    <!DOCTYPE html><html><head><title>Pi Camera Stream</title></head>
-    <body><h1>Pi Camera Stream Backend</h1>
-    <p>MJPEG stream available at <a href="/video">/video</a>.</p>
-    <img src="/video" width="640" height="480" alt="Live Stream" />
-    </body></html>
-    """
+    return index_html(list(broadcasters))
 
 if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
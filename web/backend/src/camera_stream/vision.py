@@ -0,0 +1,315 @@
+# backend/src/camera_stream/vision.py
+# Optional analysis stage that tracks a coloured object or ArUco markers in the
+# camera image and publishes their positions over MQTT, so the arm can react to
+# what the camera sees.
+#
+# Detection runs in a separate process. The broadcaster only copies each
+# published frame into a shared-memory slot that holds the latest frame; the
+# worker always picks up the newest one, so frames it has no time for are
+# skipped instead of queued. Latency samples are sent back to this process and
+# exposed on /metrics.
+import json
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from . import metrics
+from .camera import FRAME_SIZE
+
+VISION_DETECTOR_ENV = os.environ.get("VISION_DETECTOR", "off").lower() # off, colour or aruco
+VISION_SOURCE_ENV = os.environ.get("VISION_SOURCE", "") # Camera source name, default: the first one
+VISION_WIDTH_ENV = int(os.environ.get("VISION_WIDTH", "320")) # Width of the downscaled copy that is analysed
+VISION_RATE_ENV = float(os.environ.get("VISION_RATE", "10")) # Max. analysed frames and MQTT messages per second
+# HSV range of the tracked colour (OpenCV hue is 0-179), default: green
+VISION_HSV_LOWER_ENV = os.environ.get("VISION_HSV_LOWER", "35,80,60")
+VISION_HSV_UPPER_ENV = os.environ.get("VISION_HSV_UPPER", "85,255,255")
+VISION_MIN_AREA_ENV = float(os.environ.get("VISION_MIN_AREA", "0.001")) # Fraction of the image
+VISION_ARUCO_DICT_ENV = os.environ.get("VISION_ARUCO_DICT", "DICT_4X4_50")
+VISION_TOPIC_ENV = os.environ.get("VISION_TOPIC", "vision/targets")
+MQTT_HOST_ENV = os.environ.get("MQTT_HOST", "localhost")
+MQTT_PORT_ENV = int(os.environ.get("MQTT_PORT", "1883"))
+
+# Header of the shared frame slot: sequence number, capture timestamp, height, width, channels
+SLOT_HEADER = struct.Struct("<Qdiii")
+SLOT_DATA_OFFSET = 32
+
+
+@dataclass(frozen=True)
+class VisionConfig:
+    source: str
+    detector: str = "colour"
+    width: int = VISION_WIDTH_ENV
+    rate: float = VISION_RATE_ENV
+    hsv_lower: tuple = (35, 80, 60)
+    hsv_upper: tuple = (85, 255, 255)
+    min_area: float = VISION_MIN_AREA_ENV
+    aruco_dict: str = VISION_ARUCO_DICT_ENV
+    topic: str = VISION_TOPIC_ENV
+    mqtt_host: str = MQTT_HOST_ENV
+    mqtt_port: int = MQTT_PORT_ENV
+
+
+class ColourBlobDetector:
+    """
+    Finds the largest blob within an HSV colour range. Returns its centre and
+    bounding box size as fractions of the image, so results do not depend on
+    the analysis resolution.
+    """
+
+    def __init__(self, lower, upper, min_area=0.001):
+        self.lower = np.array(lower, dtype=np.uint8)
+        self.upper = np.array(upper, dtype=np.uint8)
+        self.min_area = min_area
+        self._kernel = np.ones((3, 3), np.uint8)
+
+    def detect(self, image):
+        height, width = image.shape[:2]
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, self.lower, self.upper)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self._kernel) # Drops single-pixel noise
+        count, _, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if count < 2:
+            return []
+        areas = stats[1:, cv2.CC_STAT_AREA] # Label 0 is the background
+        best = int(np.argmax(areas)) + 1
+        if stats[best, cv2.CC_STAT_AREA] < self.min_area * width * height:
+            return []
+        x, y = centroids[best]
+        return [{
+            "x": round(float(x) / width, 4),
+            "y": round(float(y) / height, 4),
+            "w": round(float(stats[best, cv2.CC_STAT_WIDTH]) / width, 4),
+            "h": round(float(stats[best, cv2.CC_STAT_HEIGHT]) / height, 4),
+        }]
+
+
+class MarkerDetector:
+    """Finds ArUco markers and returns the id and centre of each one, as fractions of the image."""
+
+    def __init__(self, dictionary="DICT_4X4_50"):
+        aruco_dict = cv2.aruco.getPredefinedDictionary(getattr(cv2.aruco, dictionary))
+        if hasattr(cv2.aruco, "ArucoDetector"):
+            self._detect = cv2.aruco.ArucoDetector(aruco_dict).detectMarkers
+        else:
+            # OpenCV before 4.7
+            self._detect = lambda image: cv2.aruco.detectMarkers(image, aruco_dict)
+
+    def detect(self, image):
+        height, width = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        corners, ids, _ = self._detect(gray)
+        if ids is None:
+            return []
+        centres = np.array([c.reshape(4, 2).mean(axis=0) for c in corners])
+        sizes = np.array([np.ptp(c.reshape(4, 2), axis=0) for c in corners])
+        return [
+            {"id": int(marker_id), "x": round(float(cx) / width, 4), "y": round(float(cy) / height, 4),
+             "w": round(float(sw) / width, 4), "h": round(float(sh) / height, 4)}
+            for marker_id, (cx, cy), (sw, sh) in zip(ids.flatten(), centres, sizes)
+        ]
+
+
+def create_detector(config):
+    if config.detector == "aruco":
+        return MarkerDetector(config.aruco_dict)
+    return ColourBlobDetector(config.hsv_lower, config.hsv_upper, config.min_area)
+
+
+def _connect_mqtt(config):
+    # paho-mqtt is optional (`uv sync --extra vision`); without it results are only measured
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        print("WARN: paho-mqtt not installed, vision results will not be published.")
+        return None
+    if hasattr(mqtt, "CallbackAPIVersion"):
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    else:
+        client = mqtt.Client()
+    # Connects (and reconnects) in the background; messages are dropped while the broker is away
+    client.connect_async(config.mqtt_host, config.mqtt_port, 60)
+    client.loop_start()
+    return client
+
+
+def _vision_main(config, shm_name, lock, ready, stop, stats):
+    # Worker process: analyse the newest frame in the slot at most config.rate times per second
+    shm = shared_memory.SharedMemory(name=shm_name)
+    data = np.ndarray((shm.size - SLOT_DATA_OFFSET,), dtype=np.uint8, buffer=shm.buf, offset=SLOT_DATA_OFFSET)
+    detector = create_detector(config)
+    client = _connect_mqtt(config)
+    interval = 1.0 / config.rate if config.rate > 0 else 0.0
+    last_seq = 0
+    last_targets = None
+    next_run = 0.0
+    try:
+        while not stop.is_set():
+            delay = next_run - time.monotonic()
+            if delay > 0:
+                stop.wait(delay)
+                # Whatever is in the slot has been waiting; prefer the next capture if it comes soon
+                ready.clear()
+                ready.wait(timeout=0.1)
+            elif not ready.wait(timeout=0.5):
+                continue
+            ready.clear()
+            with lock:
+                seq, timestamp, height, width, channels = SLOT_HEADER.unpack_from(shm.buf, 0)
+                if seq == last_seq:
+                    continue
+                image = data[:height * width * channels].reshape(height, width, channels).copy()
+            skipped = max(0, seq - last_seq - 1) if last_seq else 0
+            last_seq = seq
+            next_run = max(next_run, time.monotonic()) + interval
+
+            started = time.perf_counter()
+            if width > config.width:
+                small_height = max(1, round(height * config.width / width))
+                image = cv2.resize(image, (config.width, small_height), interpolation=cv2.INTER_AREA)
+            targets = detector.detect(image)
+            detected_at = time.time()
+            processing = time.perf_counter() - started
+
+            published_at = None
+            # An empty result is only sent once, when the target is lost
+            if client is not None and (targets or last_targets):
+                payload = json.dumps({"source": config.source, "seq": seq, "timestamp": timestamp, "targets": targets})
+                if client.publish(config.topic, payload).rc == 0:
+                    published_at = time.time()
+            last_targets = targets
+
+            try:
+                stats.put_nowait((timestamp, detected_at, published_at, processing, skipped, len(targets)))
+            except queue.Full:
+                pass
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if client is not None:
+            client.loop_stop()
+            client.disconnect()
+        shm.close()
+
+
+class VisionStage:
+    """
+    Feeds the frames of one broadcaster into a detection worker process and records
+    its latency metrics. Register with start(); the capture thread never waits on
+    the worker, a frame is skipped if the worker is reading the slot at that moment.
+    """
+
+    def __init__(self, broadcaster, config, frame_size=FRAME_SIZE):
+        self._broadcaster = broadcaster
+        self.config = config
+        self.source = config.source
+        self._capacity = frame_size[0] * frame_size[1] * 3
+        self._ctx = multiprocessing.get_context("spawn") # Never fork the threaded server
+        self._lock = self._ctx.Lock()
+        self._ready = self._ctx.Event()
+        self._stop = self._ctx.Event()
+        self._stats = self._ctx.Queue(maxsize=256)
+        self._shm = None
+        self._data = None
+        self._process = None
+        self._stats_thread = None
+
+    def start(self):
+        self._shm = shared_memory.SharedMemory(create=True, size=SLOT_DATA_OFFSET + self._capacity)
+        SLOT_HEADER.pack_into(self._shm.buf, 0, 0, 0.0, 0, 0, 0)
+        self._data = np.ndarray((self._capacity,), dtype=np.uint8, buffer=self._shm.buf, offset=SLOT_DATA_OFFSET)
+        self._stop.clear()
+        self._process = self._ctx.Process(
+            target=_vision_main, name=f"vision-{self.source}", daemon=True,
+            args=(self.config, self._shm.name, self._lock, self._ready, self._stop, self._stats),
+        )
+        self._process.start()
+        self._stats_thread = threading.Thread(target=self._collect_stats, name=f"vision-stats-{self.source}", daemon=True)
+        self._stats_thread.start()
+        self._broadcaster.add_listener(self._on_frame)
+        print(f"INFO: Vision stage '{self.config.detector}' started on source '{self.source}' (pid {self._process.pid}).")
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._broadcaster.remove_listener(self._on_frame)
+        self._stop.set()
+        self._ready.set()
+        self._process.join(timeout=3)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process = None
+        self._stats.put(None) # Ends the stats thread
+        self._stats_thread.join(timeout=1)
+        self._data = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+        print("INFO: Vision stage stopped.")
+
+    def _on_frame(self, frame):
+        # Runs on the capture thread: one memcpy into the slot, never a wait
+        image = frame.image
+        if image is None or self._data is None:
+            return
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        if image.nbytes > self._capacity:
+            # Camera delivered more than the configured size; shrink to fit the slot
+            scale = (self._capacity / image.nbytes) ** 0.5
+            image = cv2.resize(image, (int(image.shape[1] * scale), int(image.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        if not self._lock.acquire(block=False):
+            return # The worker is copying the previous frame; it will get the next one
+        try:
+            height, width, channels = image.shape
+            np.copyto(self._data[:image.nbytes].reshape(image.shape), image)
+            SLOT_HEADER.pack_into(self._shm.buf, 0, frame.seq, frame.timestamp, height, width, channels)
+        finally:
+            self._lock.release()
+        self._ready.set()
+
+    def _collect_stats(self):
+        while True:
+            sample = self._stats.get()
+            if sample is None:
+                return
+            timestamp, detected_at, published_at, processing, skipped, _ = sample
+            metrics.vision_frames.inc(self.source)
+            if skipped:
+                metrics.vision_skipped.inc(self.source, amount=skipped)
+            metrics.vision_processing_seconds.observe(processing, self.source)
+            metrics.vision_latency_seconds.observe(detected_at - timestamp, self.source, "detected")
+            if published_at is not None:
+                metrics.vision_latency_seconds.observe(published_at - timestamp, self.source, "published")
+
+
+def _parse_hsv(value):
+    return tuple(int(part) for part in value.split(","))
+
+
+def create_vision_stage(broadcasters):
+    """
+    Returns a VisionStage for the configured source (VISION_DETECTOR=colour|aruco),
+    or None when the vision stage is disabled.
+    """
+    if VISION_DETECTOR_ENV in ("", "off", "0"):
+        return None
+    if VISION_DETECTOR_ENV not in ("colour", "color", "aruco"):
+        raise ValueError(f"Unknown VISION_DETECTOR '{VISION_DETECTOR_ENV}', expected colour or aruco")
+    source = VISION_SOURCE_ENV or next(iter(broadcasters))
+    if source not in broadcasters:
+        raise ValueError(f"VISION_SOURCE '{source}' is not a configured camera source")
+    config = VisionConfig(
+        source=source,
+        detector="aruco" if VISION_DETECTOR_ENV == "aruco" else "colour",
+        hsv_lower=_parse_hsv(VISION_HSV_LOWER_ENV),
+        hsv_upper=_parse_hsv(VISION_HSV_UPPER_ENV),
+    )
+    return VisionStage(broadcasters[source], config)